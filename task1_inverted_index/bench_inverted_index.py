@@ -0,0 +1,217 @@
+"""
+Benchmarks for inverted_index.py
+
+python3 bench_inverted_index.py tokenizer [--lines 20000] [--words 200]
+python3 bench_inverted_index.py index [--docs 20000] [--words 100] [--vocabulary 50000]
+    [--zipf 1.1] [--queries 2000] [--policies simple,binary,compressed]
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import random
+import re
+import resource
+import tempfile
+import time
+
+import inverted_index
+
+
+def legacy_get_words(string):
+    string = re.sub(r"^\W+", "", string)
+    string = re.sub(r"\W+$", "", string)
+    return [t for t in re.split(pattern=r"\W", string=string) if len(t) > 0]
+
+
+def legacy_extract_document(line):
+    line = re.sub(r"\W+$", "", re.sub(r"^\W+", "", line))
+    if len(line) > 0:
+        doc_id, text = [t for t in re.split(pattern=r"\W+", string=line, maxsplit=1) if len(t) > 0]
+        return str(doc_id), re.sub(r"\W+$", "", re.sub(r"^\W+", "", text))
+    else:
+        return None, None
+
+
+def generate_lines(lines, words, seed=0):
+    rnd = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(1000)] + [",", ".", "(see", "also)", "—"]
+    return [
+        f"{doc_id}\t" + " ".join(rnd.choice(vocabulary) for _ in range(words)) + "\n"
+        for doc_id in range(lines)
+    ]
+
+
+def measure(name, tokenize_line, lines):
+    start = time.perf_counter()
+    tokens = 0
+    for line in lines:
+        tokens += len(tokenize_line(line))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {tokens / elapsed:>14,.0f} tokens/sec  ({elapsed:.3f} sec)")
+
+
+def bench_tokenizer(arguments):
+    lines = generate_lines(arguments.lines, arguments.words)
+    tokenizer = inverted_index.TOKENIZER
+    measure(
+        "legacy regex chain",
+        lambda line: legacy_get_words(legacy_extract_document(line)[1]),
+        lines
+    )
+    measure(
+        "split_document+tokenize",
+        lambda line: tokenizer.tokenize(tokenizer.split_document(line)[1]),
+        lines
+    )
+    measure(
+        "document_tokens",
+        lambda line: tokenizer.document_tokens(line)[1],
+        lines
+    )
+
+
+POLICIES = {
+    "simple": inverted_index.SimplePolicy,
+    "binary": inverted_index.BinaryPolicy,
+    "compressed": inverted_index.CompressedPolicy,
+}
+
+
+def zipf_sampler(vocabulary_size, exponent, rnd):
+    vocabulary = [f"term{rank}" for rank in range(vocabulary_size)]
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) ** exponent for rank in range(vocabulary_size)))
+    return lambda k: rnd.choices(vocabulary, cum_weights=cum_weights, k=k)
+
+
+def generate_corpus(docs, words, vocabulary_size, exponent, seed=0):
+    """
+    documents of Zipf-distributed terms, reproducible for a given seed
+    """
+    sample = zipf_sampler(vocabulary_size, exponent, random.Random(seed))
+    return {str(doc_id): " ".join(sample(words)) for doc_id in range(docs)}
+
+
+def generate_queries(queries, vocabulary_size, exponent, seed=1):
+    rnd = random.Random(seed)
+    sample = zipf_sampler(vocabulary_size, exponent, rnd)
+    return [sample(rnd.randint(1, 3)) for _ in range(queries)]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def file_size(filepath):
+    return sum(
+        os.path.getsize(path) for path in (filepath, f"{filepath}.tf", f"{filepath}.len", f"{filepath}.pos")
+        if os.path.exists(path)
+    )
+
+
+def build_policy_index(task):
+    """
+    build and dump the index of one storage policy, runs in its own worker process
+    """
+    policy_name, corpus, filepath = task
+    start = time.perf_counter()
+    index = inverted_index.build_inverted_index(corpus)
+    build_time = time.perf_counter() - start
+    index.dump(filepath, storage_policy=POLICIES[policy_name])
+    return {
+        "policy": policy_name,
+        "build_docs_per_sec": len(corpus) / build_time,
+        "size_mb": file_size(filepath) / 2 ** 20,
+    }
+
+
+def query_policy_index(task):
+    """
+    load and query a dumped index in a fresh process, so peak RSS is the one of the policy
+    and not of the build
+    """
+    filepath, queries = task
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    index = inverted_index.InvertedIndex.load(filepath)
+    load_time = time.perf_counter() - start
+
+    latencies = []
+    for words in queries:
+        start = time.perf_counter()
+        index.query(words)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "load_ms": load_time * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_growth_mb": peak_rss_mb() - rss_before,
+        "p50_us": percentile(latencies, 0.5) * 1e6,
+        "p90_us": percentile(latencies, 0.9) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "qps": len(latencies) / sum(latencies),
+    }
+
+
+def bench_index(arguments):
+    policies = arguments.policies.split(",")
+    unknown = set(policies) - set(POLICIES)
+    if unknown:
+        raise SystemExit(f"unknown policies: {', '.join(sorted(unknown))}")
+    corpus = generate_corpus(arguments.docs, arguments.words, arguments.vocabulary, arguments.zipf, arguments.seed)
+    queries = generate_queries(arguments.queries, arguments.vocabulary, arguments.zipf, arguments.seed + 1)
+    print(
+        f"{arguments.docs} docs x {arguments.words} words, vocabulary {arguments.vocabulary}, "
+        f"zipf s={arguments.zipf}, {arguments.queries} queries, seed {arguments.seed}"
+    )
+    print(
+        f"{'policy':<12}{'build docs/s':>14}{'size MB':>10}{'load ms':>10}{'peak RSS MB':>13}"
+        f"{'+RSS MB':>10}{'p50 us':>10}{'p90 us':>10}{'p99 us':>10}{'qps':>10}"
+    )
+    # spawned workers do not inherit the corpus of this process
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as workdir:
+        for policy_name in policies:
+            filepath = os.path.join(workdir, f"{policy_name}.index")
+            with context.Pool(1) as pool:
+                row = pool.apply(build_policy_index, ((policy_name, corpus, filepath),))
+            with context.Pool(1) as pool:
+                row.update(pool.apply(query_policy_index, ((filepath, queries),)))
+            print(
+                f"{row['policy']:<12}{row['build_docs_per_sec']:>14,.0f}{row['size_mb']:>10.2f}"
+                f"{row['load_ms']:>10.1f}{row['peak_rss_mb']:>13.1f}{row['rss_growth_mb']:>10.1f}"
+                f"{row['p50_us']:>10.1f}{row['p90_us']:>10.1f}{row['p99_us']:>10.1f}{row['qps']:>10,.0f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for inverted_index.py')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    tokenizer_parser = subparsers.add_parser("tokenizer", help="tokens per second of dataset lines")
+    tokenizer_parser.add_argument('--lines', action="store", dest="lines", type=int, default=20000)
+    tokenizer_parser.add_argument('--words', action="store", dest="words", type=int, default=200)
+    tokenizer_parser.set_defaults(func=bench_tokenizer)
+
+    index_parser = subparsers.add_parser("index", help="build, size, load and query latency per storage policy")
+    index_parser.add_argument('--docs', action="store", dest="docs", type=int, default=20000)
+    index_parser.add_argument('--words', action="store", dest="words", type=int, default=100)
+    index_parser.add_argument('--vocabulary', action="store", dest="vocabulary", type=int, default=50000)
+    index_parser.add_argument('--zipf', action="store", dest="zipf", type=float, default=1.1)
+    index_parser.add_argument('--queries', action="store", dest="queries", type=int, default=2000)
+    index_parser.add_argument('--seed', action="store", dest="seed", type=int, default=0)
+    index_parser.add_argument('--policies', action="store", dest="policies", type=str,
+                              default=",".join(POLICIES))
+    index_parser.set_defaults(func=bench_index)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,84 @@
 import argparse
+import asyncio
 from pdb import help
 import re
-from collections import defaultdict
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict
+from collections.abc import Mapping, Sequence
+from bisect import bisect_left
+import mmap
+import multiprocessing
+import os
 import struct
+import sys
 import array
+import zlib
 from pdb import set_trace
 
+BINARY_MAGIC = b"IIDX"
+BINARY_VERSION = 4
+# magic, version, posting codec
+BINARY_HEADER = struct.Struct("<4sHH")
+# term offset, term length, postings offset, postings count, postings size in bytes
+BINARY_ENTRY = struct.Struct("<QIQII")
+# postings count flag of BinaryPolicy entries stored as RoaringBitmap, since version 4
+BITMAP_POSTINGS = 1 << 31
+# term blob offset, entry table offset, term count, magic
+BINARY_FOOTER_V1 = struct.Struct("<QQQ4s")
+# version 2 adds the offset of the block checksum table
+BINARY_FOOTER_V2 = struct.Struct("<QQQQ4s")
+# version 3 adds the build id shared with the sidecar files, 0 if there are none,
+# version 4 keeps the footer and adds BITMAP_POSTINGS entries
+BINARY_FOOTER = struct.Struct("<QQQQQ4s")
+# sidecar files written next to an index file with term frequencies and positions
+SIDECAR_SUFFIXES = (".tf", ".len", ".pos")
+# build id, document count, average and minimal document length of a .len sidecar
+DOC_LENGTHS_HEADER = struct.Struct("<QQdi")
+# offset table item of a PositionsPolicy entry, start and end of one document's positions
+POSITION_OFFSET = struct.Struct("<I")
+POSITION_BOUNDS = struct.Struct("<II")
+# terms are spread over checksum blocks by crc32 of the term,
+# a block checksum is the sum of 64-bit blake2b digests of its terms and postings
+CHECKSUM_BLOCKS = 256
+BLOCK_CHECKSUMS = struct.Struct(f"<{CHECKSUM_BLOCKS}Q")
+# term length, postings count of a spilled run record
+RUN_RECORD = struct.Struct("<II")
+# rough size of a dict entry with its key and array object
+TERM_OVERHEAD_BYTES = 150
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+DEFAULT_SERVE_HOST = "127.0.0.1"
+DEFAULT_SERVE_PORT = 8765
+MAX_CACHED_PREFIXES = 100000
+QUERY_READ_BUFFER = 1024 * 1024
+QUERY_BATCH_SIZE = 10000
+BM25_K1 = 1.2
+BM25_B = 0.75
+DEFAULT_TOP_K = 10
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+# approximate size of a cache entry besides its payload
+CACHE_ENTRY_OVERHEAD_BYTES = 100
+SERVE_STATS_COMMAND = b"#stats"
+# LRUCache.get default telling a miss apart from a cached None
+NOT_CACHED = object()
+# roaring containers switch from arrays to bitsets above ROARING_ARRAY_MAX ids
+ROARING_ARRAY_MAX = 4096
+ROARING_CONTAINER_BYTES = 65536 // 8
+# high 16 bits of the ids, 1 for a bitset container, number of ids
+ROARING_CONTAINER = struct.Struct("<HHI")
+# posting lists at least this long and dense are kept as bitmaps in memory and on disk
+DENSE_MIN_SIZE = 4096
+DENSE_MIN_DENSITY = 1 / 16
+PHRASE_RE = re.compile(r'"([^"]*)"')
+NEAR_RE = re.compile(r"\bNEAR/(\d+)\b")
+BOOLEAN_TOKEN_RE = re.compile(r"\(|\)|\w+(?:\*|~\d+)?")
+
 
 class StoragePolicy:
     @staticmethod
@@ -46,101 +119,2114 @@ class SimplePolicy(StoragePolicy):
         return result
 
 
+def postings_bytes(docs):
+    """
+    little endian int32 bytes of a posting list sorted by doc id
+    """
+    docs = as_sorted_array(docs)
+    if sys.byteorder == "big":
+        docs = array.array("i", docs)
+        docs.byteswap()
+    return docs.tobytes()
+
+
+class BinaryPolicy(StoragePolicy):
+    """
+    Binary layout which is opened with mmap, so only touched posting lists are read:
+    header | packed posting arrays | term blob | sorted entry table | footer
+    Terms are sorted by their utf-8 bytes, lookup is a binary search over the entry table.
+    Dense posting lists are packed as RoaringBitmap containers and loaded as bitmaps.
+    """
+    CODEC = 0
+
+    @staticmethod
+    def encode_postings(docs):
+        if not isinstance(docs, RoaringBitmap):
+            docs = as_sorted_array(docs)
+            if not is_dense(docs):
+                return len(docs), postings_bytes(docs)
+            docs = RoaringBitmap(docs)
+        return len(docs) | BITMAP_POSTINGS, docs.to_bytes()
+
+    @staticmethod
+    def decode_postings(buffer, offset, count, size):
+        if count & BITMAP_POSTINGS:
+            return RoaringBitmap.from_bytes(buffer[offset:offset + size])
+        docs = array.array("i")
+        docs.frombytes(buffer[offset:offset + size])
+        if sys.byteorder == "big":
+            docs.byteswap()
+        return docs
+
+    @classmethod
+    def canonical_postings(cls, docs, data):
+        """
+        representation independent bytes of a posting list for block checksums
+        """
+        return postings_bytes(docs) if isinstance(docs, RoaringBitmap) else data
+
+    @classmethod
+    def dump(cls, word_to_doc_mapping, filepath, build_id=0):
+        items = sorted(
+            (word.encode(), docs) for word, docs in word_to_doc_mapping.items()
+        )
+        cls.dump_sorted(items, filepath, build_id)
+
+    @classmethod
+    def dump_sorted(cls, items, filepath, build_id=0):
+        """
+        write (encoded word, docs) pairs which are already sorted by the encoded word,
+        build_id ties the file to its sidecars
+        """
+        entries = []
+        terms = bytearray()
+        checksums = BlockChecksums()
+        with open(filepath, 'wb') as fp:
+            fp.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, cls.CODEC))
+            position = BINARY_HEADER.size
+            for word_enc, docs in items:
+                count, data = cls.encode_postings(docs)
+                entries.append((len(terms), len(word_enc), position, count, len(data)))
+                checksums.add(word_enc, cls.canonical_postings(docs, data))
+                terms += word_enc
+                fp.write(data)
+                position += len(data)
+            terms_offset = position
+            fp.write(terms)
+            table_offset = terms_offset + len(terms)
+            for entry in entries:
+                fp.write(BINARY_ENTRY.pack(*entry))
+            checksums_offset = table_offset + len(entries) * BINARY_ENTRY.size
+            fp.write(BLOCK_CHECKSUMS.pack(*checksums.blocks))
+            fp.write(BINARY_FOOTER.pack(
+                terms_offset, table_offset, len(entries), checksums_offset, build_id, BINARY_MAGIC
+            ))
+
+    @classmethod
+    def load(cls, filepath):
+        return MmapPostings(filepath, codec=cls.CODEC, decode_postings=cls.decode_postings)
+
+
+class CompressedPolicy(BinaryPolicy):
+    """
+    BinaryPolicy layout with delta + varint encoded posting lists,
+    posting lists are loaded as CompressedPostings without decoding
+    """
+    CODEC = 1
+
+    @staticmethod
+    def encode_postings(docs):
+        if not isinstance(docs, CompressedPostings):
+            docs = CompressedPostings(docs)
+        return len(docs), docs.data
+
+    @staticmethod
+    def decode_postings(buffer, offset, count, size):
+        return CompressedPostings.from_encoded(buffer[offset:offset + size], count)
+
+    @classmethod
+    def canonical_postings(cls, docs, data):
+        return postings_bytes(docs)
+
+
+class FrequenciesPolicy(BinaryPolicy):
+    """
+    BinaryPolicy layout for term frequency arrays aligned with the posting lists,
+    the arrays are stored as is without sorting
+    """
+    CODEC = 2
+
+    @staticmethod
+    def encode_postings(freqs):
+        freqs = array.array("i", freqs)
+        if sys.byteorder == "big":
+            freqs.byteswap()
+        return len(freqs), freqs.tobytes()
+
+
+class PositionsPolicy(BinaryPolicy):
+    """
+    BinaryPolicy layout for position lists aligned with the posting lists:
+    a table of count + 1 uint32 offsets followed by every document's
+    varint-delta encoded positions, so one document's positions are sliced directly
+    """
+    CODEC = 4
+
+    @staticmethod
+    def encode_postings(position_lists):
+        offsets = array.array("I", [0])
+        for encoded in position_lists:
+            offsets.append(offsets[-1] + len(encoded))
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        return len(position_lists), offsets.tobytes() + b"".join(position_lists)
+
+    @staticmethod
+    def decode_postings(buffer, offset, count, size):
+        return PositionLists(buffer, offset, count)
+
+
+class PositionLists(Sequence):
+    """
+    Encoded position lists of one PositionsPolicy entry, read on access
+    """
+    __slots__ = ("_buffer", "_offset", "_count")
+
+    def __init__(self, buffer, offset, count):
+        self._buffer = buffer
+        self._offset = offset
+        self._count = count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        start, end = POSITION_BOUNDS.unpack_from(self._buffer, self._offset + i * POSITION_OFFSET.size)
+        data_offset = self._offset + (self._count + 1) * POSITION_OFFSET.size
+        return self._buffer[data_offset + start:data_offset + end]
+
+    def __len__(self):
+        return self._count
+
+
+class DocLengths(dict):
+    """
+    doc id -> length in tokens with the average and minimal length computed once
+    """
+    def __init__(self, lengths=(), average=None, minimum=None):
+        super().__init__(lengths)
+        if average is None:
+            average = sum(self.values()) / len(self) if len(self) > 0 else 0.0
+        if minimum is None:
+            minimum = min(self.values(), default=0)
+        self.average = average
+        self.minimum = minimum
+
+
+def dump_doc_lengths(doc_lengths, filepath, build_id=0):
+    doc_ids = array.array("i", doc_lengths.keys())
+    lengths = array.array("i", doc_lengths.values())
+    with open(filepath, "wb") as fp:
+        fp.write(DOC_LENGTHS_HEADER.pack(build_id, len(doc_ids), doc_lengths.average, doc_lengths.minimum))
+        fp.write(doc_ids.tobytes())
+        fp.write(lengths.tobytes())
+
+
+def load_doc_lengths(filepath):
+    """
+    build id and DocLengths of a file written by dump_doc_lengths
+    """
+    with open(filepath, "rb") as fp:
+        build_id, count, average, minimum = DOC_LENGTHS_HEADER.unpack(fp.read(DOC_LENGTHS_HEADER.size))
+        doc_ids = array.array("i")
+        doc_ids.frombytes(fp.read(count * doc_ids.itemsize))
+        lengths = array.array("i")
+        lengths.frombytes(fp.read(count * lengths.itemsize))
+    return build_id, DocLengths(zip(doc_ids, lengths), average, minimum)
+
+
+def term_block(word_enc):
+    return zlib.crc32(word_enc) % CHECKSUM_BLOCKS
+
+
+class BlockChecksums:
+    """
+    Order independent checksums of terms with their postings, one per block of terms
+    """
+    MASK = (1 << 64) - 1
+
+    def __init__(self, blocks=None):
+        self.blocks = list(blocks) if blocks is not None else [0] * CHECKSUM_BLOCKS
+
+    def add(self, word_enc, canonical_postings):
+        digest = hashlib.blake2b(word_enc, digest_size=8)
+        digest.update(b"\0")
+        digest.update(canonical_postings)
+        block = term_block(word_enc)
+        self.blocks[block] = (self.blocks[block] + int.from_bytes(digest.digest(), "little")) & self.MASK
+
+    @classmethod
+    def of_mapping(cls, word_to_doc_mapping):
+        checksums = cls()
+        for word, docs in word_to_doc_mapping.items():
+            checksums.add(word.encode(), postings_bytes(docs))
+        return checksums
+
+    def mismatching_blocks(self, other):
+        return {i for i, (left, right) in enumerate(zip(self.blocks, other.blocks)) if left != right}
+
+
+class MmapPostings(Mapping):
+    """
+    Read-only word -> docs mapping over a file written by BinaryPolicy
+    """
+    def __init__(self, filepath, codec, decode_postings):
+        self._decode_postings = decode_postings
+        # the mapping keeps its own descriptor, so it stays valid until closed or collected
+        with open(filepath, 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, file_codec = BINARY_HEADER.unpack_from(self._mm, 0)
+        self.checksums = None
+        self.build_id = 0
+        if version == 1:
+            terms_offset, table_offset, count, footer_magic = BINARY_FOOTER_V1.unpack_from(
+                self._mm, len(self._mm) - BINARY_FOOTER_V1.size
+            )
+        elif version in (2, 3, BINARY_VERSION):
+            if version == 2:
+                terms_offset, table_offset, count, checksums_offset, footer_magic = BINARY_FOOTER_V2.unpack_from(
+                    self._mm, len(self._mm) - BINARY_FOOTER_V2.size
+                )
+            else:
+                terms_offset, table_offset, count, checksums_offset, self.build_id, footer_magic = (
+                    BINARY_FOOTER.unpack_from(self._mm, len(self._mm) - BINARY_FOOTER.size)
+                )
+            self.checksums = BlockChecksums(BLOCK_CHECKSUMS.unpack_from(self._mm, checksums_offset))
+        else:
+            raise ValueError(f"unsupported binary inverted index version {version}")
+        if magic != BINARY_MAGIC or footer_magic != BINARY_MAGIC:
+            raise ValueError(f"{filepath} is not a binary inverted index")
+        if file_codec != codec:
+            raise ValueError(f"{filepath} uses posting codec {file_codec}, expected {codec}")
+        self._terms_offset = terms_offset
+        self._table_offset = table_offset
+        self._count = count
+
+    def _entry(self, i):
+        return BINARY_ENTRY.unpack_from(self._mm, self._table_offset + i * BINARY_ENTRY.size)
+
+    def _term(self, entry):
+        start = self._terms_offset + entry[0]
+        return self._mm[start:start + entry[1]]
+
+    def _find(self, word_enc):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            term = self._term(entry)
+            if term < word_enc:
+                lo = mid + 1
+            elif term > word_enc:
+                hi = mid
+            else:
+                return entry
+        return None
+
+    def term_at(self, i):
+        return self._term(self._entry(i))
+
+    def __getitem__(self, word):
+        entry = self._find(word.encode())
+        if entry is None:
+            raise KeyError(word)
+        return self._decode_postings(self._mm, entry[2], entry[3], entry[4])
+
+    def __contains__(self, word):
+        return self._find(word.encode()) is not None
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._term(self._entry(i)).decode("utf-8")
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._mm.close()
+
+
+class SortedTermList:
+    """
+    Sorted encoded terms of an in-memory mapping, same interface as MmapPostings.term_at
+    """
+    def __init__(self, words):
+        self._terms = sorted(word.encode() for word in words)
+
+    def term_at(self, i):
+        return self._terms[i]
+
+    def __len__(self):
+        return len(self._terms)
+
+
+def next_prefix(prefix: bytes):
+    """
+    smallest byte string greater than every string starting with prefix, None if there is none
+    """
+    prefix = prefix.rstrip(b"\xff")
+    if len(prefix) == 0:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+class TermDictionary:
+    """
+    Exact, prefix and bounded edit distance lookups over terms sorted by their utf-8 bytes.
+    The sorted terms are walked as an implicit trie: Levenshtein rows are shared between
+    terms with a common prefix and whole prefix ranges are skipped by binary search
+    once the distance can only exceed the bound.
+    """
+    def __init__(self, terms):
+        self._terms = terms
+
+    def _lower_bound(self, key: bytes, lo=0):
+        hi = len(self._terms)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._terms.term_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def exact(self, word):
+        key = word.encode()
+        i = self._lower_bound(key)
+        return i < len(self._terms) and self._terms.term_at(i) == key
+
+    def prefix(self, prefix):
+        key = prefix.encode()
+        i = self._lower_bound(key)
+        while i < len(self._terms):
+            term = self._terms.term_at(i)
+            if not term.startswith(key):
+                break
+            yield term.decode("utf-8")
+            i += 1
+
+    def fuzzy(self, word, max_distance):
+        """
+        generate terms within max_distance insertions, deletions or substitutions of word
+        """
+        size = len(self._terms)
+        rows = [list(range(len(word) + 1))]
+        prev = ""
+        i = 0
+        while i < size:
+            term = self._terms.term_at(i).decode("utf-8")
+            common = 0
+            limit = min(len(term), len(prev), len(rows) - 1)
+            while common < limit and term[common] == prev[common]:
+                common += 1
+            del rows[common + 1:]
+            pruned_at = None
+            for k in range(common, len(term)):
+                above = rows[k]
+                row = [above[0] + 1]
+                for j in range(1, len(word) + 1):
+                    row.append(min(
+                        row[j - 1] + 1,
+                        above[j] + 1,
+                        above[j - 1] + (word[j - 1] != term[k])
+                    ))
+                rows.append(row)
+                if min(row) > max_distance:
+                    pruned_at = k + 1
+                    break
+            if pruned_at is None:
+                if rows[-1][-1] <= max_distance:
+                    yield term
+                prev = term
+                i += 1
+            else:
+                prev = term[:pruned_at]
+                key = next_prefix(prev.encode())
+                i = size if key is None else self._lower_bound(key, i + 1)
+
+
+def union_postings(postings_lists):
+    """
+    sorted array of doc ids found in any of the posting lists
+    """
+    result = array.array("i")
+    prev = None
+    for doc_id in heapq.merge(*(as_sorted_array(docs) for docs in postings_lists)):
+        if doc_id != prev:
+            result.append(doc_id)
+            prev = doc_id
+    return result
+
+
+def detect_policy(filepath):
+    """
+    choose storage policy by the file signature
+    """
+    with open(filepath, 'rb') as fp:
+        header = fp.read(BINARY_HEADER.size)
+    if len(header) == BINARY_HEADER.size:
+        magic, _, codec = BINARY_HEADER.unpack(header)
+        if magic == BINARY_MAGIC:
+            for policy in (BinaryPolicy, CompressedPolicy):
+                if policy.CODEC == codec:
+                    return policy
+    return SimplePolicy
+
+
+def encode_varint_deltas(docs):
+    """
+    encode sorted non-negative doc ids as varint gaps between neighbours
+    """
+    result = bytearray()
+    prev = 0
+    for doc_id in docs:
+        gap = doc_id - prev
+        if gap < 0:
+            raise ValueError("doc ids must be sorted and non-negative")
+        prev = doc_id
+        while gap >= 0x80:
+            result.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        result.append(gap)
+    return bytes(result)
+
+
+def decode_varint_deltas(data):
+    """
+    generate doc ids encoded by encode_varint_deltas
+    """
+    doc_id = 0
+    gap = 0
+    shift = 0
+    for byte in data:
+        gap |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            doc_id += gap
+            yield doc_id
+            gap = 0
+            shift = 0
+
+
+class CompressedPostings:
+    """
+    Sorted posting list kept as delta + varint encoded bytes
+    """
+    __slots__ = ("data", "count")
+
+    def __init__(self, docs=()):
+        docs = sorted(docs)
+        self.data = encode_varint_deltas(docs)
+        self.count = len(docs)
+
+    @classmethod
+    def from_encoded(cls, data, count):
+        postings = cls.__new__(cls)
+        postings.data = bytes(data)
+        postings.count = count
+        return postings
+
+    def __iter__(self):
+        return decode_varint_deltas(self.data)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, doc_id):
+        for value in self:
+            if value >= doc_id:
+                return value == doc_id
+        return False
+
+    def __eq__(self, other):
+        if isinstance(other, CompressedPostings):
+            return self.data == other.data
+        try:
+            return set(self) == set(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return f"CompressedPostings({list(self)})"
+
+
+def _bits_to_array(bits):
+    """
+    sorted array('H') of the positions of set bits
+    """
+    result = array.array("H")
+    for i, byte in enumerate(bits.to_bytes(ROARING_CONTAINER_BYTES, "little")):
+        if byte:
+            base = i << 3
+            for j in range(8):
+                if byte >> j & 1:
+                    result.append(base + j)
+    return result
+
+
+def _array_to_bits(values):
+    bits = bytearray(ROARING_CONTAINER_BYTES)
+    for value in values:
+        bits[value >> 3] |= 1 << (value & 7)
+    return int.from_bytes(bits, "little")
+
+
+def _container_size(container):
+    if isinstance(container, int):
+        return container.bit_count()
+    return len(container)
+
+
+def _normalize_container(container):
+    """
+    keep small containers as sorted arrays and large ones as bitsets, None for empty
+    """
+    if isinstance(container, int):
+        size = container.bit_count()
+        if size == 0:
+            return None
+        if size <= ROARING_ARRAY_MAX:
+            return _bits_to_array(container)
+        return container
+    if len(container) == 0:
+        return None
+    if len(container) > ROARING_ARRAY_MAX:
+        return _array_to_bits(container)
+    return container
+
+
+def _container_and(left, right):
+    if isinstance(left, int) and isinstance(right, int):
+        return left & right
+    if isinstance(left, int):
+        left, right = right, left
+    if isinstance(right, int):
+        return array.array("H", (value for value in left if right >> value & 1))
+    small, large = (left, right) if len(left) <= len(right) else (right, left)
+    return array.array("H", gallop_intersect(small, large))
+
+
+def _container_or(left, right):
+    if isinstance(left, int) or isinstance(right, int):
+        if not isinstance(left, int):
+            left = _array_to_bits(left)
+        if not isinstance(right, int):
+            right = _array_to_bits(right)
+        return left | right
+    result = array.array("H")
+    prev = -1
+    for value in heapq.merge(left, right):
+        if value != prev:
+            result.append(value)
+            prev = value
+    return result
+
+
+def _container_andnot(left, right):
+    if isinstance(right, int):
+        if isinstance(left, int):
+            return left & ~right
+        return array.array("H", (value for value in left if not right >> value & 1))
+    if isinstance(left, int):
+        return left & ~_array_to_bits(right)
+    right = set(right)
+    return array.array("H", (value for value in left if value not in right))
+
+
+class RoaringBitmap:
+    """
+    Roaring-style compressed bitmap of doc ids: ids are grouped by their high 16 bits,
+    every group is a sorted array('H') of the low bits while it holds at most
+    ROARING_ARRAY_MAX ids and an int used as a 65536 bit bitset otherwise
+    """
+    __slots__ = ("containers",)
+
+    def __init__(self, docs=()):
+        groups = defaultdict(list)
+        for doc_id in docs:
+            groups[doc_id >> 16].append(doc_id & 0xffff)
+        self.containers = dict()
+        for key in sorted(groups):
+            container = _normalize_container(array.array("H", sorted(set(groups[key]))))
+            if container is not None:
+                self.containers[key] = container
+
+    @classmethod
+    def _from_containers(cls, containers):
+        bitmap = cls.__new__(cls)
+        bitmap.containers = containers
+        return bitmap
+
+    @staticmethod
+    def _combine(operation, keys):
+        containers = dict()
+        for key in keys:
+            container = _normalize_container(operation(key))
+            if container is not None:
+                containers[key] = container
+        return RoaringBitmap._from_containers(containers)
+
+    def __and__(self, other):
+        keys = sorted(self.containers.keys() & other.containers.keys())
+        return self._combine(
+            lambda key: _container_and(self.containers[key], other.containers[key]), keys
+        )
+
+    def __or__(self, other):
+        def operation(key):
+            if key not in other.containers:
+                return self.containers[key]
+            if key not in self.containers:
+                return other.containers[key]
+            return _container_or(self.containers[key], other.containers[key])
+        keys = sorted(self.containers.keys() | other.containers.keys())
+        return self._combine(operation, keys)
+
+    def __sub__(self, other):
+        def operation(key):
+            if key not in other.containers:
+                return self.containers[key]
+            return _container_andnot(self.containers[key], other.containers[key])
+        return self._combine(operation, list(self.containers))
+
+    def __iter__(self):
+        for key, container in self.containers.items():
+            base = key << 16
+            if isinstance(container, int):
+                container = _bits_to_array(container)
+            for value in container:
+                yield base + value
+
+    def __len__(self):
+        return sum(_container_size(container) for container in self.containers.values())
+
+    def __contains__(self, doc_id):
+        container = self.containers.get(doc_id >> 16)
+        if container is None:
+            return False
+        low = doc_id & 0xffff
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        pos = bisect_left(container, low)
+        return pos < len(container) and container[pos] == low
+
+    def __eq__(self, other):
+        if isinstance(other, RoaringBitmap):
+            return self.containers == other.containers
+        try:
+            return list(self) == sorted(other)
+        except TypeError:
+            return NotImplemented
+
+    def rank(self, doc_id):
+        """
+        number of ids less than doc_id
+        """
+        result = 0
+        low = doc_id & 0xffff
+        for key, container in self.containers.items():
+            if key >= doc_id >> 16:
+                if key == doc_id >> 16:
+                    if isinstance(container, int):
+                        result += (container & ((1 << low) - 1)).bit_count()
+                    else:
+                        result += bisect_left(container, low)
+                break
+            result += _container_size(container)
+        return result
+
+    def to_array(self):
+        return array.array("i", self)
+
+    def to_bytes(self):
+        """
+        containers in key order, each one is a ROARING_CONTAINER header
+        followed by little endian array('H') ids or a bitset of ROARING_CONTAINER_BYTES
+        """
+        data = bytearray()
+        for key, container in self.containers.items():
+            if isinstance(container, int):
+                data += ROARING_CONTAINER.pack(key, 1, container.bit_count())
+                data += container.to_bytes(ROARING_CONTAINER_BYTES, "little")
+            else:
+                data += ROARING_CONTAINER.pack(key, 0, len(container))
+                if sys.byteorder == "big":
+                    container = array.array("H", container)
+                    container.byteswap()
+                data += container.tobytes()
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        containers = dict()
+        pos = 0
+        while pos < len(data):
+            key, is_bitset, count = ROARING_CONTAINER.unpack_from(data, pos)
+            pos += ROARING_CONTAINER.size
+            if is_bitset:
+                containers[key] = int.from_bytes(data[pos:pos + ROARING_CONTAINER_BYTES], "little")
+                pos += ROARING_CONTAINER_BYTES
+            else:
+                container = array.array("H")
+                container.frombytes(data[pos:pos + count * container.itemsize])
+                if sys.byteorder == "big":
+                    container.byteswap()
+                containers[key] = container
+                pos += count * container.itemsize
+        return cls._from_containers(containers)
+
+    def __repr__(self):
+        return f"RoaringBitmap({list(self)})"
+
+
+def as_bitmap(docs):
+    if isinstance(docs, RoaringBitmap):
+        return docs
+    return RoaringBitmap(docs)
+
+
+def is_dense(docs, min_size=DENSE_MIN_SIZE, min_density=DENSE_MIN_DENSITY):
+    """
+    whether a sorted posting list is cheaper to keep as a bitmap
+    """
+    if len(docs) < min_size:
+        return False
+    return len(docs) / (docs[-1] - docs[0] + 1) >= min_density
+
+
+def postings_rank(docs, doc_id):
+    """
+    number of doc ids less than doc_id in a sorted array or a bitmap
+    """
+    if isinstance(docs, RoaringBitmap):
+        return docs.rank(doc_id)
+    return bisect_left(docs, doc_id)
+
+
+def as_sorted_array(docs):
+    """
+    convert posting list of any supported representation to a sorted array('i')
+    """
+    if isinstance(docs, array.array):
+        return docs
+    if isinstance(docs, (CompressedPostings, RoaringBitmap)):
+        return array.array("i", docs)
+    return array.array("i", sorted(docs))
+
+
+def gallop_intersect(small, large):
+    """
+    intersect two sorted arrays, every element of the smaller one is searched
+    in the larger one with exponential (galloping) search from the last position
+    """
+    result = array.array("i")
+    size = len(large)
+    pos = 0
+    for doc_id in small:
+        if pos >= size:
+            break
+        bound = 1
+        while pos + bound < size and large[pos + bound] < doc_id:
+            bound *= 2
+        pos = bisect_left(large, doc_id, pos + bound // 2, min(pos + bound + 1, size))
+        if pos < size and large[pos] == doc_id:
+            result.append(doc_id)
+            pos += 1
+    return result
+
+
+def gallop_union(small, large):
+    """
+    union of two sorted arrays: every element of the smaller one is located
+    in the larger one by binary search and the runs between them are copied as slices
+    """
+    if len(small) > len(large):
+        small, large = large, small
+    result = array.array("i")
+    pos = 0
+    for doc_id in small:
+        found = bisect_left(large, doc_id, pos)
+        result.extend(large[pos:found])
+        result.append(doc_id)
+        pos = found + 1 if found < len(large) and large[found] == doc_id else found
+    result.extend(large[pos:])
+    return result
+
+
+def gallop_difference(docs, removed):
+    """
+    sorted array of docs which are not in removed, iterating the smaller of the two
+    """
+    result = array.array("i")
+    if len(docs) <= len(removed):
+        pos = 0
+        for doc_id in docs:
+            pos = bisect_left(removed, doc_id, pos)
+            if pos >= len(removed) or removed[pos] != doc_id:
+                result.append(doc_id)
+        return result
+    pos = 0
+    for doc_id in removed:
+        found = bisect_left(docs, doc_id, pos)
+        result.extend(docs[pos:found])
+        pos = found + 1 if found < len(docs) and docs[found] == doc_id else found
+    result.extend(docs[pos:])
+    return result
+
+
+def intersect_postings(postings_lists):
+    """
+    intersect posting lists starting from the rarest term,
+    stops as soon as the intersection becomes empty
+    """
+    postings_lists = sorted(postings_lists, key=len)
+    if len(postings_lists) == 0:
+        return array.array("i")
+    bitmaps = [docs for docs in postings_lists if isinstance(docs, RoaringBitmap)]
+    others = [docs for docs in postings_lists if not isinstance(docs, RoaringBitmap)]
+    bitmap = None
+    if len(bitmaps) > 0:
+        bitmap = bitmaps[0]
+        for docs in bitmaps[1:]:
+            bitmap = bitmap & docs
+    if len(others) == 0:
+        return bitmap.to_array()
+    result = as_sorted_array(others[0])
+    for docs in others[1:]:
+        if len(result) == 0:
+            break
+        result = gallop_intersect(result, as_sorted_array(docs))
+    if bitmap is not None:
+        result = array.array("i", (doc_id for doc_id in result if doc_id in bitmap))
+    return result
+
+
+def parse_boolean_query(expression):
+    """
+    parse boolean query into nodes ("word", word), ("or", children), ("and", positives, negatives);
+    NOT binds tighter than implicit AND which binds tighter than OR
+    """
+    tokens = BOOLEAN_TOKEN_RE.findall(expression)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def parse_or():
+        nonlocal position
+        children = [parse_and()]
+        while peek() == "OR":
+            position += 1
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else ("or", children)
+
+    def parse_and():
+        nonlocal position
+        positives, negatives = [], []
+        while peek() not in (None, "OR", ")"):
+            if peek() == "AND":
+                position += 1
+                continue
+            negated = False
+            while peek() == "NOT":
+                position += 1
+                negated = not negated
+            node = parse_atom()
+            (negatives if negated else positives).append(node)
+        if len(positives) + len(negatives) == 0:
+            raise ValueError(f"empty boolean expression in {expression!r}")
+        if len(positives) == 1 and len(negatives) == 0:
+            return positives[0]
+        return ("and", positives, negatives)
+
+    def parse_atom():
+        nonlocal position
+        token = peek()
+        if token is None or token in (")", "OR", "AND"):
+            raise ValueError(f"unexpected {token!r} in boolean query {expression!r}")
+        position += 1
+        if token == "(":
+            node = parse_or()
+            if peek() != ")":
+                raise ValueError(f"unbalanced parentheses in boolean query {expression!r}")
+            position += 1
+            return node
+        return ("word", token)
+
+    result = parse_or()
+    if position != len(tokens):
+        raise ValueError(f"unexpected {peek()!r} in boolean query {expression!r}")
+    return result
+
+
+def phrase_matches(positions):
+    """
+    whether some position p of the first word has p + i among positions of the i-th word
+    """
+    following = [set(word_positions) for word_positions in positions[1:]]
+    return any(
+        all(start + i in word_positions for i, word_positions in enumerate(following, 1))
+        for start in positions[0]
+    )
+
+
+def near_matches(positions, distance):
+    """
+    whether every two neighbouring words have occurrences at most distance tokens apart
+    """
+    for left, right in zip(positions, positions[1:]):
+        i = j = 0
+        found = False
+        while i < len(left) and j < len(right):
+            if abs(left[i] - right[j]) <= distance:
+                found = True
+                break
+            if left[i] < right[j]:
+                i += 1
+            else:
+                j += 1
+        if not found:
+            return False
+    return True
+
+
+class LRUCache:
+    """
+    Least recently used cache bounded by the total size of its values in bytes
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value, size):
+        size += CACHE_ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.used_bytes -= old[1]
+        self._items[key] = (value, size)
+        self.used_bytes += size
+        while self.used_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.used_bytes -= evicted_size
+
+    def clear(self):
+        self._items.clear()
+        self.used_bytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "items": len(self._items),
+            "bytes": self.used_bytes,
+        }
+
+
+class QueryCache:
+    """
+    Decoded posting lists and normalized query results sharing one byte budget
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.postings = LRUCache(max_bytes // 2)
+        self.results = LRUCache(max_bytes - max_bytes // 2)
+
+    def clear(self):
+        self.postings.clear()
+        self.results.clear()
+
+    def stats(self):
+        return {"postings": self.postings.stats(), "results": self.results.stats()}
+
+
+def postings_nbytes(docs):
+    if isinstance(docs, array.array):
+        return len(docs) * docs.itemsize
+    if isinstance(docs, CompressedPostings):
+        return len(docs.data)
+    if isinstance(docs, RoaringBitmap):
+        return sum(
+            ROARING_CONTAINER_BYTES if isinstance(container, int) else len(container) * container.itemsize
+            for container in docs.containers.values()
+        )
+    return len(docs) * 8
+
+
+def result_nbytes(result):
+    return sum(len(doc_id) + 50 for doc_id in result)
+
+
+def same_postings(left, right):
+    """
+    compare posting lists which may have different representations
+    """
+    if type(left) is type(right):
+        return left == right
+    return as_sorted_array(left) == as_sorted_array(right)
+
+
+class IndexDiff:
+    """
+    Difference between two indexes: added and removed terms,
+    changed maps a common term to (added doc ids, removed doc ids)
+    """
+    def __init__(self):
+        self.added_terms = []
+        self.removed_terms = []
+        self.changed = dict()
+
+    def __bool__(self):
+        return bool(self.added_terms or self.removed_terms or self.changed)
+
+    def __repr__(self):
+        return (
+            f"IndexDiff(added_terms={self.added_terms}, "
+            f"removed_terms={self.removed_terms}, changed={self.changed})"
+        )
+
+
 class InvertedIndex:
     def __init__(self):
         self.data = None
+        # word -> term frequencies aligned with self.data[word], DocLengths
+        self.term_freqs = None
+        self.doc_lengths = None
+        # word -> varint-delta encoded token positions aligned with self.data[word]
+        self.positions = None
+        self._all_documents = None
+        self._term_dictionary = None
+        self.cache = None
 
     def query(self, words: list) -> list:
         """Return the list of relevant documents for the given query"""
-        intersection = None
+        if self.cache is not None:
+            key = tuple(sorted(set(words)))
+            result = self.cache.results.get(key)
+            if result is None:
+                result = tuple(self._query(words))
+                self.cache.results.put(key, result, result_nbytes(result))
+            # cached results are immutable, callers get their own list
+            return list(result)
+        return self._query(words)
+
+    def _query(self, words):
+        postings_lists = []
         for word in words:
-            if intersection is None:
-                intersection = self.data[word].copy()
+            docs = self.lookup(word)
+            if docs is None:
+                return []
+            postings_lists.append(docs)
+        return [str(v) for v in intersect_postings(postings_lists)]
+
+    def enable_cache(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        """Cache decoded posting lists and query results in LRU caches of max_bytes in total"""
+        self.cache = QueryCache(max_bytes)
+        return self
+
+    def invalidate_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+    def query_phrase(self, words: list) -> list:
+        """Return documents where the words occur consecutively in the given order"""
+        return self._query_positions(words, phrase_matches)
+
+    def query_near(self, words: list, distance: int) -> list:
+        """Return documents where every two neighbouring words are at most distance tokens apart"""
+        return self._query_positions(words, lambda positions: near_matches(positions, distance))
+
+    def query_positional(self, expression: str) -> list:
+        """
+        Return documents for "a quoted phrase", a NEAR/k b [NEAR/k c ...] or plain words
+        """
+        phrase = PHRASE_RE.fullmatch(expression.strip())
+        if phrase is not None:
+            return self.query_phrase(get_words(phrase.group(1)))
+        parts = NEAR_RE.split(expression)
+        if len(parts) > 1:
+            words = [get_words(part) for part in parts[::2]]
+            distances = {int(distance) for distance in parts[1::2]}
+            if any(len(part) != 1 for part in words) or len(distances) != 1:
+                raise ValueError(f"NEAR/k must join single words with the same k: {expression!r}")
+            return self.query_near([part[0] for part in words], distances.pop())
+        return self.query(TOKENIZER.tokenize_query(expression))
+
+    def _query_positions(self, words, matches):
+        """
+        intersect documents first and read positions only for the candidates
+        """
+        if self.positions is None:
+            raise ValueError("index was built without positions")
+        postings = []
+        for word in words:
+            docs = self.data.get(word)
+            if docs is None:
+                return []
+            postings.append(docs if isinstance(docs, RoaringBitmap) else as_sorted_array(docs))
+        position_lists = [self.positions[word] for word in words]
+        result = []
+        for doc_id in intersect_postings(postings):
+            positions = [
+                list(decode_varint_deltas(doc_positions[postings_rank(docs, doc_id)]))
+                for docs, doc_positions in zip(postings, position_lists)
+            ]
+            if matches(positions):
+                result.append(str(doc_id))
+        return result
+
+    def lookup(self, word):
+        """
+        posting list of a query token: word, prefix* or word~N, None if nothing matches
+        """
+        if self.cache is None:
+            return self._lookup(word)
+        docs = self.cache.postings.get(word, NOT_CACHED)
+        if docs is NOT_CACHED:
+            docs = self._lookup(word)
+            if isinstance(docs, CompressedPostings):
+                docs = as_sorted_array(docs)
+            self.cache.postings.put(word, docs, 0 if docs is None else postings_nbytes(docs))
+        return docs
+
+    def _lookup(self, word):
+        if word.endswith("*"):
+            words = list(self.term_dictionary().prefix(word[:-1]))
+        elif "~" in word:
+            base, max_distance = word.rsplit("~", 1)
+            words = list(self.term_dictionary().fuzzy(base, int(max_distance)))
+        else:
+            return self.data.get(word)
+        if len(words) == 0:
+            return None
+        if len(words) == 1:
+            return self.data[words[0]]
+        return union_postings(self.data[word] for word in words)
+
+    def term_dictionary(self):
+        """
+        sorted term dictionary, read straight from the file of mmap-backed indexes
+        """
+        if isinstance(self.data, MmapPostings):
+            return TermDictionary(self.data)
+        cached = self._term_dictionary
+        if cached is None or cached[0] is not self.data:
+            cached = (self.data, TermDictionary(SortedTermList(self.data.keys())))
+            self._term_dictionary = cached
+        return cached[1]
+
+    def query_ranked(self, words: list, top_k: int = DEFAULT_TOP_K,
+                     k1: float = BM25_K1, b: float = BM25_B) -> list:
+        """Return top_k documents containing any of the words ordered by BM25 score"""
+        return [str(doc_id) for score, doc_id in self.top_k_bm25(words, top_k, k1, b)]
+
+    def top_k_bm25(self, words, top_k=DEFAULT_TOP_K, k1=BM25_K1, b=BM25_B):
+        """
+        (score, doc_id) pairs of the best top_k documents by BM25,
+        documents are skipped with WAND when their score upper bound can not enter the top
+        """
+        if self.term_freqs is None or self.doc_lengths is None:
+            raise ValueError("index was built without term frequencies")
+        if top_k <= 0 or len(self.doc_lengths) == 0:
+            return []
+        total_docs = len(self.doc_lengths)
+        avg_length = self.doc_lengths.average
+        min_length = self.doc_lengths.minimum
+        terms = []
+        for word in set(words):
+            docs = self.data.get(word)
+            if not docs:
+                continue
+            docs = as_sorted_array(docs)
+            freqs = self.term_freqs[word]
+            idf = math.log(1 + (total_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            max_tf = max(freqs)
+            upper_bound = idf * max_tf * (k1 + 1) / (
+                max_tf + k1 * (1 - b + b * min_length / avg_length)
+            )
+            # cursor: [current position, docs, freqs, idf, upper bound]
+            terms.append([0, docs, freqs, idf, upper_bound])
+        top = []
+        threshold = 0.0
+        while len(terms) > 0:
+            terms.sort(key=lambda term: term[1][term[0]])
+            bound = 0.0
+            pivot = None
+            for i, term in enumerate(terms):
+                bound += term[4]
+                if bound > threshold:
+                    pivot = i
+                    break
+            if pivot is None:
+                break
+            pivot_doc = terms[pivot][1][terms[pivot][0]]
+            if terms[0][1][terms[0][0]] == pivot_doc:
+                length_norm = k1 * (1 - b + b * self.doc_lengths[pivot_doc] / avg_length)
+                score = 0.0
+                for term in terms:
+                    position, docs, freqs, idf, _ = term
+                    if docs[position] != pivot_doc:
+                        break
+                    tf = freqs[position]
+                    score += idf * tf * (k1 + 1) / (tf + length_norm)
+                    term[0] += 1
+                if len(top) < top_k:
+                    heapq.heappush(top, (score, -pivot_doc))
+                elif score > top[0][0]:
+                    heapq.heapreplace(top, (score, -pivot_doc))
+                if len(top) == top_k:
+                    threshold = top[0][0]
             else:
-                intersection &= self.data[word]
-        return [str(v) for v in intersection]
+                for term in terms[:pivot]:
+                    term[0] = bisect_left(term[1], pivot_doc, term[0])
+            terms = [term for term in terms if term[0] < len(term[1])]
+        return [(score, -neg_doc_id) for score, neg_doc_id in sorted(top, reverse=True)]
+
+    def query_boolean(self, expression: str) -> list:
+        """
+        Return documents matching a boolean query: words separated by spaces (or AND)
+        must all match, OR joins alternatives, NOT excludes, parentheses group
+        """
+        return [str(v) for v in self._evaluate(parse_boolean_query(expression))]
+
+    def _evaluate(self, node):
+        """
+        bitmap algebra when both operands are bitmaps (dense lists, in memory or loaded
+        from BinaryPolicy files), galloping over sorted arrays otherwise
+        """
+        kind = node[0]
+        if kind == "word":
+            docs = self.lookup(node[1])
+            if docs is None:
+                return array.array("i")
+            return docs if isinstance(docs, RoaringBitmap) else as_sorted_array(docs)
+        if kind == "or":
+            result = array.array("i")
+            for child in node[1]:
+                docs = self._evaluate(child)
+                if isinstance(result, RoaringBitmap) and isinstance(docs, RoaringBitmap):
+                    result = result | docs
+                elif len(result) == 0:
+                    result = docs
+                elif len(docs) > 0:
+                    result = gallop_union(as_sorted_array(result), as_sorted_array(docs))
+            return result
+        positives, negatives = node[1], node[2]
+        if len(positives) > 0:
+            parts = []
+            for child in positives:
+                docs = self._evaluate(child)
+                if len(docs) == 0:
+                    return array.array("i")
+                parts.append(docs)
+            result = parts[0] if len(parts) == 1 else intersect_postings(parts)
+        else:
+            result = self.all_documents()
+        for child in negatives:
+            if len(result) == 0:
+                break
+            docs = self._evaluate(child)
+            if isinstance(result, RoaringBitmap) and isinstance(docs, RoaringBitmap):
+                result = result - docs
+            elif len(docs) > 0:
+                result = gallop_difference(as_sorted_array(result), as_sorted_array(docs))
+        return result
+
+    def all_documents(self):
+        """
+        bitmap of every indexed doc id, needed only for queries without positive words
+        """
+        if self.doc_lengths is not None:
+            return RoaringBitmap(self.doc_lengths.keys())
+        cached = self._all_documents
+        if cached is None or cached[0] is not self.data:
+            result = RoaringBitmap()
+            for docs in self.data.values():
+                result = result | as_bitmap(docs)
+            cached = (self.data, result)
+            self._all_documents = cached
+        return cached[1]
+
+    def optimize_postings(self, min_size=DENSE_MIN_SIZE, min_density=DENSE_MIN_DENSITY):
+        """Keep dense posting lists as RoaringBitmap"""
+        for word, docs in self.data.items():
+            if not isinstance(docs, RoaringBitmap):
+                docs = as_sorted_array(docs)
+                if is_dense(docs, min_size, min_density):
+                    self.data[word] = RoaringBitmap(docs)
+        return self
+
+    def compress(self):
+        """Replace posting sets with delta + varint encoded CompressedPostings"""
+        self.data = {
+            word: docs if isinstance(docs, CompressedPostings) else CompressedPostings(docs)
+            for word, docs in self.data.items()
+        }
+        return self
 
     def dump(self, filepath: str, storage_policy=None):
+        """
+        sidecars are tied to the index file by a random build id in its footer,
+        sidecars left by a previous build at the same path are removed
+        """
         if storage_policy is None:
-            storage_policy = SimplePolicy
-        storage_policy.dump(word_to_doc_mapping=self.data, filepath=filepath)
+            storage_policy = BinaryPolicy
+        for suffix in SIDECAR_SUFFIXES:
+            if os.path.exists(filepath + suffix):
+                os.remove(filepath + suffix)
+        if self.term_freqs is None and self.positions is None:
+            storage_policy.dump(word_to_doc_mapping=self.data, filepath=filepath)
+            return
+        if not issubclass(storage_policy, BinaryPolicy):
+            raise ValueError("term frequencies and positions need a binary storage policy")
+        build_id = int.from_bytes(os.urandom(8), "little") | 1
+        storage_policy.dump(word_to_doc_mapping=self.data, filepath=filepath, build_id=build_id)
+        if self.term_freqs is not None:
+            FrequenciesPolicy.dump(self.term_freqs, f"{filepath}.tf", build_id)
+            dump_doc_lengths(self.doc_lengths, f"{filepath}.len", build_id)
+        if self.positions is not None:
+            PositionsPolicy.dump(self.positions, f"{filepath}.pos", build_id)
 
     @classmethod
     def load(cls, filepath: str, storage_policy=None):
+        """
+        sidecars are used only if their build id matches the one of the index file
+        """
+        if os.path.isdir(filepath):
+            return SegmentedIndex(filepath)
         if storage_policy is None:
-            storage_policy = SimplePolicy
+            storage_policy = detect_policy(filepath)
         ii = InvertedIndex()
         ii.data = storage_policy.load(filepath=filepath)
+        build_id = getattr(ii.data, "build_id", 0)
+        if build_id == 0:
+            return ii
+        if os.path.exists(f"{filepath}.tf") and os.path.exists(f"{filepath}.len"):
+            term_freqs = FrequenciesPolicy.load(f"{filepath}.tf")
+            lengths_build_id, doc_lengths = load_doc_lengths(f"{filepath}.len")
+            if term_freqs.build_id == lengths_build_id == build_id:
+                ii.term_freqs = term_freqs
+                ii.doc_lengths = doc_lengths
+            else:
+                term_freqs.close()
+        if os.path.exists(f"{filepath}.pos"):
+            positions = PositionsPolicy.load(f"{filepath}.pos")
+            if positions.build_id == build_id:
+                ii.positions = positions
+            else:
+                positions.close()
         return ii
 
+    def block_checksums(self):
+        """
+        block checksums stored in the index file, computed for in-memory indexes
+        """
+        if isinstance(self.data, MmapPostings) and self.data.checksums is not None:
+            return self.data.checksums
+        return BlockChecksums.of_mapping(self.data)
+
+    def has_stored_checksums(self):
+        return isinstance(self.data, MmapPostings) and self.data.checksums is not None
+
+    def diff(self, other):
+        """
+        terms and postings changed from self to other,
+        only terms of blocks with different checksums are compared
+        """
+        blocks = self.block_checksums().mismatching_blocks(other.block_checksums())
+        result = IndexDiff()
+        if len(blocks) == 0:
+            return result
+        left_terms = {word for word in self.data if term_block(word.encode()) in blocks}
+        right_terms = {word for word in other.data if term_block(word.encode()) in blocks}
+        result.added_terms = sorted(right_terms - left_terms)
+        result.removed_terms = sorted(left_terms - right_terms)
+        for word in sorted(left_terms & right_terms):
+            left_docs = as_sorted_array(self.data[word])
+            right_docs = as_sorted_array(other.data[word])
+            if left_docs != right_docs:
+                left_set, right_set = set(left_docs), set(right_docs)
+                result.changed[word] = (sorted(right_set - left_set), sorted(left_set - right_set))
+        return result
+
     def __eq__(self, other):
+        if self.has_stored_checksums() and other.has_stored_checksums():
+            return not self.diff(other)
         if self.data.keys() != other.data.keys():
             # set_trace()
             return False
         else:
             result = True
             for key in self.data.keys():
-                if self.data[key] != other.data[key]:
+                if not same_postings(self.data[key], other.data[key]):
                     # set_trace()
                     result = False
                     break
             return result
 
 
+class Tokenizer:
+    """
+    Single pass tokenizer shared by build and query paths,
+    a token is a maximal run of word characters
+    """
+    WORD_RE = re.compile(r"\w+")
+    # query tokens may end with * (prefix) or ~N (at most N edits)
+    QUERY_RE = re.compile(r"\w+(?:\*|~\d+)?")
+    DOC_ID_RE = re.compile(r"\W*(\w+)")
+    TEXT_RE = re.compile(r"\W*(\w+(?:\W+\w+)*)")
+
+    def tokenize(self, text):
+        return self.WORD_RE.findall(text)
+
+    def tokenize_query(self, text):
+        return self.QUERY_RE.findall(text)
+
+    def split_document(self, line):
+        """
+        split dataset line into doc id and text stripped of non-word characters
+        """
+        match = self.DOC_ID_RE.match(line)
+        if match is None:
+            return None, None
+        text = self.TEXT_RE.match(line, match.end())
+        return match.group(1), "" if text is None else text.group(1)
+
+    def document_tokens(self, line):
+        """
+        doc id and tokens of the document text in one pass over the dataset line
+        """
+        tokens = self.WORD_RE.findall(line)
+        if len(tokens) == 0:
+            return None, []
+        return tokens[0], tokens[1:]
+
+
+TOKENIZER = Tokenizer()
+
+
 def get_words(string):
-    # print(f"string: '{string}'")
-    string = re.sub(r"^\W+", "", string)
-    string = re.sub(r"\W+$", "", string)
-    return [t for t in re.split(pattern=r"\W", string=string) if len(t) > 0]
+    return TOKENIZER.tokenize(string)
 
 
 def extract_document(line):
-    line = re.sub(r"\W+$", "", re.sub(r"^\W+", "", line))
-    if len(line) > 0:
-        doc_id, text = [t for t in re.split(pattern=r"\W+", string=line, maxsplit=1) if len(t) > 0]
-        return str(doc_id), re.sub(r"\W+$", "", re.sub(r"^\W+", "", text))
-    else:
-        return None, None
+    return TOKENIZER.split_document(line)
 
 
-def load_documents(dataset_path: str):
-    docs = dict()
+def iter_documents(dataset_path: str):
     with open(dataset_path, "r") as fp:
         for line in fp:
             if len(line) > 0:
                 doc_id, text = extract_document(line)
                 if doc_id is not None:
-                    docs[doc_id] = text
+                    yield doc_id, text
+
+
+def iter_document_tokens(dataset_path: str):
+    with open(dataset_path, "r") as fp:
+        for line in fp:
+            doc_id, tokens = TOKENIZER.document_tokens(line)
+            if doc_id is not None:
+                yield doc_id, tokens
+
+
+def load_documents(dataset_path: str):
+    docs = dict()
+    for doc_id, text in iter_documents(dataset_path):
+        docs[doc_id] = text
     return docs
 
 
-def build_inverted_index(docs: dict):
-    iidx_data = defaultdict(set)
-    for doc_id, text in docs.items():
-        content = set(get_words(text))
+def collect_postings(doc_tokens):
+    """
+    collect unsorted posting lists from (doc_id, tokens) pairs
+    """
+    iidx_data = defaultdict(list)
+    for doc_id, tokens in doc_tokens:
+        content = set(tokens)
         for word in content:
-            if doc_id not in iidx_data[word]:
-                iidx_data[word].add(int(doc_id))
+            iidx_data[word].append(int(doc_id))
+    return iidx_data
+
+
+def build_inverted_index(docs: dict, with_frequencies: bool = False, with_positions: bool = False):
+    if with_frequencies or with_positions:
+        return build_detailed_index(docs, with_frequencies, with_positions)
+    iidx_data = collect_postings((doc_id, get_words(text)) for doc_id, text in docs.items())
+    iidx = InvertedIndex()
+    iidx.data = {word: array.array("i", sorted(docs)) for word, docs in iidx_data.items()}
+    return iidx.optimize_postings()
+
+
+def build_detailed_index(docs: dict, with_frequencies: bool = True, with_positions: bool = False):
+    """
+    inverted index which also keeps term frequencies and document lengths for BM25
+    and/or compressed token positions of every posting for phrase queries
+    """
+    pairs = defaultdict(list)
+    doc_lengths = dict()
+    for doc_id, text in docs.items():
+        doc_id = int(doc_id)
+        words = get_words(text)
+        doc_lengths[doc_id] = len(words)
+        word_positions = defaultdict(list)
+        for position, word in enumerate(words):
+            word_positions[word].append(position)
+        for word, positions in word_positions.items():
+            pairs[word].append((doc_id, positions))
+    iidx = InvertedIndex()
+    iidx.data = dict()
+    if with_frequencies:
+        iidx.term_freqs = dict()
+        iidx.doc_lengths = DocLengths(doc_lengths)
+    if with_positions:
+        iidx.positions = dict()
+    for word, doc_positions in pairs.items():
+        doc_positions.sort()
+        iidx.data[word] = array.array("i", (doc_id for doc_id, _ in doc_positions))
+        if with_frequencies:
+            iidx.term_freqs[word] = array.array("i", (len(positions) for _, positions in doc_positions))
+        if with_positions:
+            iidx.positions[word] = [encode_varint_deltas(positions) for _, positions in doc_positions]
+    return iidx
+
+
+def split_dataset(dataset_path: str, parts: int):
+    """
+    split dataset file into byte ranges of roughly the same size
+    """
+    size = os.path.getsize(dataset_path)
+    step = max(1, -(-size // parts))
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def iter_document_range(dataset_path: str, start: int, end: int, split_line=extract_document):
+    """
+    generate documents of the lines which begin inside [start, end) byte range,
+    split_line turns a line into (doc_id, text) or (doc_id, tokens)
+    """
+    with open(dataset_path, "rb") as fp:
+        if start > 0:
+            fp.seek(start - 1)
+            fp.readline()
+        while fp.tell() < end:
+            line = fp.readline()
+            if len(line) == 0:
+                break
+            doc_id, content = split_line(line.decode("utf-8"))
+            if doc_id is not None:
+                yield doc_id, content
+
+
+def build_partial_index(task):
+    """
+    pool worker: posting lists of one byte range of the dataset
+    """
+    dataset_path, start, end = task
+    iidx_data = collect_postings(
+        iter_document_range(dataset_path, start, end, split_line=TOKENIZER.document_tokens)
+    )
+    return {word: array.array("i", docs) for word, docs in iidx_data.items()}
+
+
+def build_inverted_index_parallel(dataset_path: str, workers: int):
+    """
+    build inverted index from byte ranges of the dataset in a process pool
+    and merge partial posting lists
+    """
+    tasks = [(dataset_path, start, end) for start, end in split_dataset(dataset_path, workers)]
+    merged = defaultdict(lambda: array.array("i"))
+    with multiprocessing.Pool(workers) as pool:
+        for partial in pool.imap_unordered(build_partial_index, tasks):
+            for word, docs in partial.items():
+                merged[word].extend(docs)
     iidx = InvertedIndex()
-    iidx.data = iidx_data
+    iidx.data = {word: array.array("i", sorted(docs)) for word, docs in merged.items()}
     return iidx
 
 
+def spill_run(postings, filepath):
+    """
+    write accumulated posting lists sorted by the encoded word to a run file
+    """
+    with open(filepath, "wb") as fp:
+        for word_enc, docs in sorted((word.encode(), docs) for word, docs in postings.items()):
+            docs = array.array("i", sorted(docs))
+            fp.write(RUN_RECORD.pack(len(word_enc), len(docs)))
+            fp.write(word_enc)
+            fp.write(docs.tobytes())
+
+
+def iter_run(filepath):
+    """
+    generate (encoded word, docs) records of a run file written by spill_run
+    """
+    with open(filepath, "rb") as fp:
+        while True:
+            header = fp.read(RUN_RECORD.size)
+            if len(header) < RUN_RECORD.size:
+                break
+            term_len, count = RUN_RECORD.unpack(header)
+            word_enc = fp.read(term_len)
+            docs = array.array("i")
+            docs.frombytes(fp.read(count * docs.itemsize))
+            yield word_enc, docs
+
+
+def merge_runs(run_paths):
+    """
+    k-way merge of run files, posting lists of the same word are joined and sorted
+    """
+    runs = [iter_run(path) for path in run_paths]
+    word_enc, docs = None, None
+    for next_word_enc, next_docs in heapq.merge(*runs, key=lambda record: record[0]):
+        if next_word_enc == word_enc:
+            docs.extend(next_docs)
+            continue
+        if word_enc is not None:
+            yield word_enc, array.array("i", sorted(docs))
+        word_enc, docs = next_word_enc, next_docs
+    if word_enc is not None:
+        yield word_enc, array.array("i", sorted(docs))
+
+
+def build_inverted_index_streaming(dataset_path: str, output: str,
+                                   memory_budget: int = DEFAULT_MEMORY_BUDGET,
+                                   storage_policy=None):
+    """
+    SPIMI-style build: postings are accumulated while reading the dataset line by line,
+    spilled as sorted runs whenever the estimated size exceeds memory_budget bytes,
+    and the runs are merged straight into the output index file
+    """
+    if storage_policy is None:
+        storage_policy = BinaryPolicy
+    with tempfile.TemporaryDirectory(prefix="inverted_index_") as tmpdir:
+        run_paths = []
+        postings = defaultdict(lambda: array.array("i"))
+        used = 0
+        for doc_id, tokens in iter_document_tokens(dataset_path):
+            doc_id = int(doc_id)
+            for word in set(tokens):
+                docs = postings[word]
+                if len(docs) == 0:
+                    used += TERM_OVERHEAD_BYTES + len(word)
+                docs.append(doc_id)
+                used += docs.itemsize
+            if used >= memory_budget:
+                run_paths.append(os.path.join(tmpdir, f"run_{len(run_paths)}"))
+                spill_run(postings, run_paths[-1])
+                postings.clear()
+                used = 0
+        if len(postings) > 0 or len(run_paths) == 0:
+            run_paths.append(os.path.join(tmpdir, f"run_{len(run_paths)}"))
+            spill_run(postings, run_paths[-1])
+        storage_policy.dump_sorted(merge_runs(run_paths), output)
+
+
+class TombstoneBitmap:
+    """
+    Bitmap of deleted doc ids, bit (doc_id % 8) of byte (doc_id // 8)
+    """
+    def __init__(self, data=b""):
+        self.data = bytearray(data)
+
+    def add(self, doc_id):
+        byte = doc_id >> 3
+        if byte >= len(self.data):
+            self.data.extend(bytes(byte + 1 - len(self.data)))
+        self.data[byte] |= 1 << (doc_id & 7)
+
+    def difference(self, other):
+        """
+        bitmap of doc ids which are in self but not in other
+        """
+        result = TombstoneBitmap(self.data)
+        for i, byte in enumerate(other.data[:len(result.data)]):
+            result.data[i] &= ~byte & 0xff
+        return result
+
+    def union(self, other):
+        """
+        bitmap of doc ids which are in self or in other
+        """
+        result = TombstoneBitmap(self.data)
+        if len(other.data) > len(result.data):
+            result.data.extend(bytes(len(other.data) - len(result.data)))
+        for i, byte in enumerate(other.data):
+            result.data[i] |= byte
+        return result
+
+    def __contains__(self, doc_id):
+        byte = doc_id >> 3
+        return byte < len(self.data) and bool(self.data[byte] & (1 << (doc_id & 7)))
+
+    def __len__(self):
+        return sum(bin(byte).count("1") for byte in self.data)
+
+    def live(self, docs):
+        """
+        sorted array of docs which are not deleted
+        """
+        docs = as_sorted_array(docs)
+        if len(self.data) == 0:
+            return docs
+        return array.array("i", (doc_id for doc_id in docs if doc_id not in self))
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath, "rb") as fp:
+            return cls(fp.read())
+
+    def dump(self, filepath):
+        write_atomic(filepath, bytes(self.data))
+
+
+def write_atomic(filepath, data: bytes):
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(data)
+    os.replace(tmp_path, filepath)
+
+
+class Segment:
+    """
+    Immutable BinaryPolicy index file with its own tombstone bitmap
+    """
+    def __init__(self, directory, name):
+        self.name = name
+        self.index_path = os.path.join(directory, name + ".index")
+        self.tombstones_path = os.path.join(directory, name + ".del")
+        self.postings = BinaryPolicy.load(self.index_path)
+        if os.path.exists(self.tombstones_path):
+            self.tombstones = TombstoneBitmap.load(self.tombstones_path)
+        else:
+            self.tombstones = TombstoneBitmap()
+
+    def live(self, word):
+        docs = self.postings.get(word)
+        if docs is None:
+            return None
+        return self.tombstones.live(docs)
+
+    def close(self):
+        self.postings.close()
+
+
+class SegmentedPostings(Mapping):
+    """
+    Read-only word -> docs mapping over live postings of all segments
+    """
+    def __init__(self, segments):
+        self._segments = list(segments)
+
+    def __getitem__(self, word):
+        parts = [docs for docs in (segment.live(word) for segment in self._segments) if docs]
+        if len(parts) == 0:
+            raise KeyError(word)
+        if len(parts) == 1:
+            return parts[0]
+        return array.array("i", heapq.merge(*parts))
+
+    def __iter__(self):
+        prev = None
+        for word in heapq.merge(*self._segments_terms(), key=str.encode):
+            if word != prev and word in self:
+                yield word
+            prev = word
+
+    def _segments_terms(self):
+        return [iter(segment.postings) for segment in self._segments]
+
+    def __contains__(self, word):
+        return any(segment.live(word) for segment in self._segments)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class SegmentedIndex(InvertedIndex):
+    """
+    LSM-style index directory: documents are appended as small segments,
+    deletions are kept in per-segment tombstone bitmaps, and segments are merged
+    into a single one on merge() or in a background thread.
+    Adding a doc id which is already indexed replaces the document.
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory, max_segments=8):
+        super().__init__()
+        self.directory = directory
+        self.max_segments = max_segments
+        self._lock = threading.RLock()
+        self._merge_lock = threading.Lock()
+        with open(os.path.join(directory, self.MANIFEST)) as fp:
+            manifest = json.load(fp)
+        self._next_segment = manifest["next_segment"]
+        self.segments = [Segment(directory, name) for name in manifest["segments"]]
+        self.data = SegmentedPostings(self.segments)
+
+    @classmethod
+    def create(cls, directory, inv_index=None, max_segments=8):
+        os.makedirs(directory, exist_ok=True)
+        manifest = {"segments": [], "next_segment": 0}
+        if inv_index is not None:
+            name = "segment_000000"
+            BinaryPolicy.dump(inv_index.data, os.path.join(directory, name + ".index"))
+            manifest = {"segments": [name], "next_segment": 1}
+        write_atomic(os.path.join(directory, cls.MANIFEST), json.dumps(manifest).encode())
+        return cls(directory, max_segments=max_segments)
+
+    def _new_segment_name(self):
+        name = f"segment_{self._next_segment:06d}"
+        self._next_segment += 1
+        return name
+
+    def _commit(self, segments):
+        manifest = {
+            "segments": [segment.name for segment in segments],
+            "next_segment": self._next_segment
+        }
+        write_atomic(os.path.join(self.directory, self.MANIFEST), json.dumps(manifest).encode())
+        self.segments = segments
+        self.data = SegmentedPostings(segments)
+        self.invalidate_cache()
+
+    def _tombstone(self, doc_ids):
+        for segment in self.segments:
+            for doc_id in doc_ids:
+                segment.tombstones.add(doc_id)
+            segment.tombstones.dump(segment.tombstones_path)
+        self.data = SegmentedPostings(self.segments)
+        self.invalidate_cache()
+
+    def add_documents(self, docs: dict):
+        """
+        index docs (doc_id -> text) as a new segment
+        """
+        with self._lock:
+            doc_ids = [int(doc_id) for doc_id in docs]
+            self._tombstone(doc_ids)
+            name = self._new_segment_name()
+            delta = build_inverted_index(docs)
+            BinaryPolicy.dump(delta.data, os.path.join(self.directory, name + ".index"))
+            self._commit(self.segments + [Segment(self.directory, name)])
+        if len(self.segments) > self.max_segments:
+            self.merge_in_background()
+
+    def delete_documents(self, doc_ids):
+        with self._lock:
+            self._tombstone([int(doc_id) for doc_id in doc_ids])
+
+    def merge(self):
+        """
+        merge all current segments into one, documents added meanwhile stay in their segments
+        """
+        with self._merge_lock:
+            with self._lock:
+                merged = list(self.segments)
+                if len(merged) <= 1:
+                    return
+                name = self._new_segment_name()
+                snapshots = [TombstoneBitmap(segment.tombstones.data) for segment in merged]
+            live = SegmentedPostings(merged)
+            BinaryPolicy.dump_sorted(
+                ((word.encode(), live[word]) for word in live),
+                os.path.join(self.directory, name + ".index")
+            )
+            with self._lock:
+                # deletions made during the merge are the new bits of the merged segments
+                segment = Segment(self.directory, name)
+                for old, snapshot in zip(merged, snapshots):
+                    segment.tombstones = segment.tombstones.union(old.tombstones.difference(snapshot))
+                segment.tombstones.dump(segment.tombstones_path)
+                self._commit([segment] + self.segments[len(merged):])
+            # queries running meanwhile may still read the merged segments,
+            # their mappings are released with the last SegmentedPostings holding them
+            for old in merged:
+                for path in (old.index_path, old.tombstones_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def merge_in_background(self):
+        thread = threading.Thread(target=self.merge, daemon=True)
+        thread.start()
+        return thread
+
+
 def buld_action(args):
-    docs = load_documents(args.dataset)
-    idx = build_inverted_index(docs)
-    idx.dump(args.output)
+    workers = getattr(args, "workers", 1)
+    memory_budget = getattr(args, "memory_budget", None)
+    storage_policy = CompressedPolicy if getattr(args, "compressed", False) else BinaryPolicy
+    with_frequencies = getattr(args, "bm25", False)
+    with_positions = getattr(args, "positions", False)
+    if (with_frequencies or with_positions) and (workers > 1 or memory_budget is not None):
+        raise ValueError("--bm25 and --positions can not be combined with --workers or --memory-budget")
+    if memory_budget is not None:
+        if workers > 1:
+            raise ValueError("--memory-budget can not be combined with --workers")
+        build_inverted_index_streaming(
+            args.dataset, args.output,
+            memory_budget=memory_budget * 1024 * 1024,
+            storage_policy=storage_policy
+        )
+        return
+    if workers > 1:
+        idx = build_inverted_index_parallel(args.dataset, workers)
+    else:
+        docs = load_documents(args.dataset)
+        idx = build_inverted_index(
+            docs, with_frequencies=with_frequencies, with_positions=with_positions
+        )
+    if storage_policy is CompressedPolicy:
+        idx.compress()
+    idx.dump(args.output, storage_policy=storage_policy)
 
 
 def process_queries(inv_index, queries):
     if queries is not None:
         for query_s in queries:
-            query = [x for x in query_s.split()]
+            query = TOKENIZER.tokenize_query(query_s)
             # set_trace()
             res = inv_index.query(query)
             print(" ".join(res))
 
 
+def process_queries_batch(inv_index, queries, output=None):
+    """
+    answer all queries at once: every distinct term is fetched once,
+    intersections of shared prefixes (terms ordered by document frequency) are cached
+    and answers go to output with a single write
+    """
+    if output is None:
+        output = sys.stdout
+    if queries is None:
+        return
+    parsed = [set(TOKENIZER.tokenize_query(query_s)) for query_s in queries]
+    postings = dict()
+    for word in set().union(*parsed):
+        docs = inv_index.lookup(word)
+        if docs is not None and not isinstance(docs, RoaringBitmap):
+            docs = as_sorted_array(docs)
+        postings[word] = docs
+    prefix_cache = dict()
+    lines = []
+    for words in parsed:
+        if any(postings[word] is None for word in words):
+            lines.append("")
+            continue
+        if inv_index.cache is not None:
+            key = tuple(sorted(words))
+            cached = inv_index.cache.results.get(key)
+            if cached is not None:
+                lines.append(" ".join(cached))
+                continue
+        words = sorted(words, key=lambda word: (len(postings[word]), word))
+        result = as_sorted_array(postings[words[0]]) if len(words) > 0 else array.array("i")
+        for i in range(1, len(words)):
+            if len(result) == 0:
+                break
+            prefix = tuple(words[:i + 1])
+            cached = prefix_cache.get(prefix)
+            if cached is None:
+                docs = postings[words[i]]
+                if isinstance(docs, RoaringBitmap):
+                    cached = array.array("i", (doc_id for doc_id in result if doc_id in docs))
+                else:
+                    cached = gallop_intersect(result, docs)
+                if len(prefix_cache) >= MAX_CACHED_PREFIXES:
+                    prefix_cache.clear()
+                prefix_cache[prefix] = cached
+            result = cached
+        answer = tuple(str(doc_id) for doc_id in result)
+        if inv_index.cache is not None:
+            inv_index.cache.results.put(key, answer, result_nbytes(answer))
+        lines.append(" ".join(answer))
+    output.write("".join(line + "\n" for line in lines))
+
+
+def process_queries_boolean(inv_index, queries, output=None):
+    """
+    answer queries with AND / OR / NOT operators
+    """
+    if output is None:
+        output = sys.stdout
+    if queries is None:
+        return
+    output.write("".join(
+        " ".join(inv_index.query_boolean(query_s)) + "\n" for query_s in queries
+    ))
+
+
+def process_queries_positional(inv_index, queries, output=None):
+    """
+    answer "phrase" and NEAR/k queries
+    """
+    if output is None:
+        output = sys.stdout
+    if queries is None:
+        return
+    output.write("".join(
+        " ".join(inv_index.query_positional(query_s)) + "\n" for query_s in queries
+    ))
+
+
+def process_queries_ranked(inv_index, queries, top_k=DEFAULT_TOP_K, output=None):
+    """
+    answer queries with top_k documents by BM25, best first
+    """
+    if output is None:
+        output = sys.stdout
+    if queries is None:
+        return
+    output.write("".join(
+        " ".join(inv_index.query_ranked(get_words(query_s), top_k)) + "\n"
+        for query_s in queries
+    ))
+
+
+def open_queries(filepath, encoding: str):
+    """
+    text stream of queries from a file or from stdin for "-", read in large chunks
+    """
+    if filepath == "-":
+        return io.TextIOWrapper(
+            io.BufferedReader(sys.stdin.buffer, buffer_size=QUERY_READ_BUFFER),
+            encoding=encoding
+        )
+    return open(filepath, encoding=encoding, buffering=QUERY_READ_BUFFER)
+
+
+def iter_query_batches(queries, batch_size: int = QUERY_BATCH_SIZE):
+    """
+    split a (possibly endless) stream of queries into lists of batch_size
+    """
+    queries = iter(queries)
+    while True:
+        batch = list(itertools.islice(queries, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def process_query_stream(process, inv_index, stream, batch_size: int = QUERY_BATCH_SIZE, output=None):
+    """
+    answer queries batch by batch, flushing answers after each batch,
+    so memory does not grow with the number of queries
+    """
+    if output is None:
+        output = sys.stdout
+    for batch in iter_query_batches(stream, batch_size):
+        process(inv_index, batch)
+        output.flush()
+
+
 def query_action(arguments):
     # set_trace()
     count = 0
@@ -164,22 +2250,92 @@ def query_action(arguments):
         raise Exception("index is undefined")
     else:
         idx = InvertedIndex.load(arguments.index)
+    cache_mb = getattr(arguments, "cache_mb", 0)
+    if cache_mb > 0:
+        idx.enable_cache(cache_mb * 1024 * 1024)
+    top_k = getattr(arguments, "top_k", None)
+    if getattr(arguments, "boolean", False):
+        process = process_queries_boolean
+    elif getattr(arguments, "positional", False):
+        process = process_queries_positional
+    elif top_k is None:
+        process = process_queries_batch
+    else:
+        def process(inv_index, queries):
+            process_queries_ranked(inv_index, queries, top_k=top_k)
     if arguments.queries is not None:
-        process_queries(idx, arguments.queries)
-    elif arguments.file_cp is not None:
-        queries = []
-        with open(arguments.file_cp, encoding='cp1251') as fp:
-            for line in fp:
-                queries.append(line)
-        process_queries(idx, queries)
-    elif arguments.file_utf is not None:
-        queries = []
-        with open(arguments.file_utf, encoding='utf8') as fp:
-            for line in fp:
-                queries.append(line)
-        process_queries(idx, queries)
+        process(idx, arguments.queries)
+    elif arguments.file_cp is not None or arguments.file_utf is not None:
+        if arguments.file_cp is not None:
+            stream = open_queries(arguments.file_cp, encoding='cp1251')
+        else:
+            stream = open_queries(arguments.file_utf, encoding='utf8')
+        try:
+            process_query_stream(process, idx, stream)
+        finally:
+            if arguments.file_cp == "-" or arguments.file_utf == "-":
+                # keep sys.stdin usable, only the wrappers are discarded
+                stream.detach().detach()
+            else:
+                stream.close()
     else:
         raise Exception("You must define --query or ----query-file-cp1251 or --query-file-utf8")
+    if idx.cache is not None:
+        print(json.dumps(idx.cache.stats()), file=sys.stderr)
+
+
+def diff_action(arguments):
+    left = InvertedIndex.load(arguments.left)
+    right = InvertedIndex.load(arguments.right)
+    result = left.diff(right)
+    for word in result.added_terms:
+        print(f"+ {word}")
+    for word in result.removed_terms:
+        print(f"- {word}")
+    for word, (added, removed) in result.changed.items():
+        print(f"~ {word} +{len(added)} -{len(removed)}")
+    return result
+
+
+async def handle_client(inv_index, reader, writer):
+    """
+    answer newline separated utf-8 queries of one client, one line of doc ids per query,
+    the #stats line is answered with json cache statistics
+    """
+    try:
+        while True:
+            line = await reader.readline()
+            if len(line) == 0:
+                break
+            if line.strip() == SERVE_STATS_COMMAND:
+                stats = inv_index.cache.stats() if inv_index.cache is not None else {}
+                writer.write((json.dumps(stats) + "\n").encode("utf-8"))
+                await writer.drain()
+                continue
+            res = inv_index.query(TOKENIZER.tokenize_query(line.decode("utf-8")))
+            writer.write((" ".join(res) + "\n").encode("utf-8"))
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_server(inv_index, host=DEFAULT_SERVE_HOST, port=DEFAULT_SERVE_PORT):
+    return await asyncio.start_server(
+        lambda reader, writer: handle_client(inv_index, reader, writer), host, port
+    )
+
+
+async def serve_forever(inv_index, host, port):
+    server = await start_server(inv_index, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def serve_action(arguments):
+    idx = InvertedIndex.load(arguments.index)
+    if arguments.cache_mb > 0:
+        idx.enable_cache(arguments.cache_mb * 1024 * 1024)
+    asyncio.run(serve_forever(idx, arguments.host, arguments.port))
 
 
 def main():
@@ -191,6 +2347,8 @@ def main():
     4) python3 inverted_index.py query --index /path/to/inverted.index --query-file-cp1251 /path/to/quries.txt
     5) cat /path/to/quries.txt | python3 inverted_index.py query --index /path/to/inverted.index --query-file-cp1251 -
     6) python3 inverted_index.py query --index /path/to/inverted.index --query first query [--query the second query]6
+    7) python3 inverted_index.py diff --left /path/to/old.index --right /path/to/new.index
+    8) python3 inverted_index.py serve --index /path/to/inverted.index [--host 127.0.0.1] [--port 8765]
     :return:
     """
 
@@ -201,6 +2359,16 @@ def main():
     build_parser = subparsers.add_parser("build", help="build inverted index")
     build_parser.add_argument('--dataset', action="store", dest="dataset", type=str, required=True)
     build_parser.add_argument('--output', action="store", dest="output", type=str, required=True)
+    build_parser.add_argument('--compressed', action="store_true", dest="compressed",
+                              help="store delta + varint compressed posting lists")
+    build_parser.add_argument('--workers', action="store", dest="workers", type=int, default=1,
+                              help="number of processes building partial indexes")
+    build_parser.add_argument('--memory-budget', action="store", dest="memory_budget", type=int,
+                              help="build with bounded memory, spilling sorted runs above this many MB")
+    build_parser.add_argument('--bm25', action="store_true", dest="bm25",
+                              help="store term frequencies and document lengths for ranked queries")
+    build_parser.add_argument('--positions', action="store_true", dest="positions",
+                              help="store token positions for phrase and NEAR/k queries")
     build_parser.set_defaults(func=buld_action)
 
     query_parser = subparsers.add_parser("query", help="build inverted index")
@@ -208,8 +2376,30 @@ def main():
     query_parser.add_argument('--query-file-utf8', action="store", dest="file_utf", type=str)
     query_parser.add_argument('--query-file-cp1251', action="store", dest="file_cp", type=str)
     query_parser.add_argument('--query', action="append", dest="queries")
+    query_parser.add_argument('--top-k', action="store", dest="top_k", type=int,
+                              help="return top k documents by BM25 instead of the boolean intersection")
+    query_parser.add_argument('--boolean', action="store_true", dest="boolean",
+                              help="queries may use OR, NOT, AND and parentheses")
+    query_parser.add_argument('--positional', action="store_true", dest="positional",
+                              help='queries may be "quoted phrases" or use NEAR/k')
+    query_parser.add_argument('--cache-mb', action="store", dest="cache_mb", type=int, default=0,
+                              help="posting list and result cache size, statistics go to stderr")
     query_parser.set_defaults(func=query_action)
 
+    diff_parser = subparsers.add_parser("diff", help="print terms and postings changed between two indexes")
+    diff_parser.add_argument('--left', action="store", dest="left", type=str, required=True)
+    diff_parser.add_argument('--right', action="store", dest="right", type=str, required=True)
+    diff_parser.set_defaults(func=diff_action)
+
+    serve_parser = subparsers.add_parser("serve", help="answer queries over tcp, one query per line")
+    serve_parser.add_argument('--index', action="store", dest="index", type=str, required=True)
+    serve_parser.add_argument('--host', action="store", dest="host", type=str, default=DEFAULT_SERVE_HOST)
+    serve_parser.add_argument('--port', action="store", dest="port", type=int, default=DEFAULT_SERVE_PORT)
+    serve_parser.add_argument('--cache-mb', action="store", dest="cache_mb", type=int,
+                              default=DEFAULT_CACHE_BYTES // (1024 * 1024),
+                              help="posting list and result cache size, 0 disables the cache")
+    serve_parser.set_defaults(func=serve_action)
+
     args = parser.parse_args()
     if not vars(args):
         parser.print_usage()
@@ -1,3 +1,13 @@
+import array
+import asyncio
+import gc
+import io
+import json
+import math
+import random
+import sys
+import threading
+import weakref
 import pytest
 import inverted_index
 from textwrap import dedent
@@ -102,6 +112,21 @@ def test_query_inverted_index_intersect_results(tiny_dataset_fio, query, etalon_
     )
 
 
+@pytest.mark.parametrize(
+    "postings_lists, expected",
+    [
+        pytest.param([[1, 5, 9], [5]], [5], id="single match"),
+        pytest.param([list(range(0, 1000, 3)), list(range(0, 1000, 5))], list(range(0, 1000, 15)), id="long lists"),
+        pytest.param([[1, 2, 3], [4, 5], list(range(100))], [], id="empty intersection"),
+        pytest.param([{7, 3, 11}, [3, 11, 20]], [3, 11], id="unsorted set"),
+        pytest.param([], [], id="no lists"),
+    ],
+)
+def test_intersect_postings(postings_lists, expected):
+    actual = inverted_index.intersect_postings(postings_lists)
+    assert expected == list(actual)
+
+
 def test_can_load_tiny_wikipedia_sample():
     documents = inverted_index.load_documents(DATASET_TINY_FPATH)
     assert len(documents) == 15, (
@@ -177,6 +202,59 @@ def test_can_save_and_load_simple_policy_tiny(tmpdir, small_wiki_inverted_index)
     )
 
 
+def test_can_save_and_load_binary_policy_tiny(tmpdir, tiny_inverted_index):
+    index_fio = tmpdir.join("index.bin")
+    mapping = tiny_inverted_index.data
+    inverted_index.BinaryPolicy.dump(mapping, index_fio)
+    mapping_loaded = inverted_index.BinaryPolicy.load(index_fio)
+    assert dict(mapping) == dict(mapping_loaded), (
+        "Load should return the same inverted index"
+    )
+    assert "A_word" in mapping_loaded
+    with pytest.raises(KeyError):
+        _ = mapping_loaded["word_does_not_exist"]
+
+
+def test_load_detects_storage_policy(tmpdir, tiny_inverted_index):
+    simple_fio = tmpdir.join("index.simple")
+    binary_fio = tmpdir.join("index.bin")
+    tiny_inverted_index.dump(simple_fio, storage_policy=inverted_index.SimplePolicy)
+    tiny_inverted_index.dump(binary_fio)
+    assert inverted_index.detect_policy(simple_fio) is inverted_index.SimplePolicy
+    assert inverted_index.detect_policy(binary_fio) is inverted_index.BinaryPolicy
+    assert inverted_index.InvertedIndex.load(simple_fio) == inverted_index.InvertedIndex.load(binary_fio)
+
+
+@pytest.mark.parametrize(
+    "docs",
+    [
+        pytest.param([], id="empty"),
+        pytest.param([0], id="zero"),
+        pytest.param([2, 37, 123, 127, 128, 300, 16384, 2 ** 31 - 1], id="varint boundaries"),
+    ],
+)
+def test_varint_deltas_roundtrip(docs):
+    data = inverted_index.encode_varint_deltas(docs)
+    assert docs == list(inverted_index.decode_varint_deltas(data))
+
+
+def test_varint_deltas_reject_unsorted_docs():
+    with pytest.raises(ValueError):
+        inverted_index.encode_varint_deltas([37, 2])
+
+
+def test_can_save_and_load_compressed_policy_tiny(tmpdir, tiny_inverted_index):
+    index_fio = tmpdir.join("index.varint")
+    etalon = inverted_index.InvertedIndex()
+    etalon.data = dict(tiny_inverted_index.data)
+    tiny_inverted_index.compress()
+    tiny_inverted_index.dump(index_fio, storage_policy=inverted_index.CompressedPolicy)
+    loaded_index = inverted_index.InvertedIndex.load(index_fio)
+    assert isinstance(loaded_index.data["A_word"], inverted_index.CompressedPostings)
+    assert etalon == loaded_index
+    assert sorted(loaded_index.query(["A_word", "and"])) == ["123", "37"]
+
+
 @pytest.mark.parametrize(
     "left, right, are_equal",
     [
@@ -301,6 +379,53 @@ def test_build_action_tiny_dataset(tiny_dataset_fio, tmpdir):
     )
 
 
+@pytest.mark.parametrize("parts", [1, 2, 3, 7, 500])
+def test_document_ranges_cover_dataset(tiny_dataset_fio, parts):
+    etalon = inverted_index.load_documents(tiny_dataset_fio)
+    actual = []
+    for start, end in inverted_index.split_dataset(tiny_dataset_fio, parts):
+        actual.extend(inverted_index.iter_document_range(tiny_dataset_fio, start, end))
+    assert sorted(etalon.items()) == sorted(actual)
+
+
+def test_build_action_tiny_dataset_parallel(tiny_dataset_fio, tmpdir):
+    docs = inverted_index.load_documents(tiny_dataset_fio)
+    etalon = inverted_index.build_inverted_index(docs)
+
+    fpath = tmpdir.join("tiny_output")
+    Args = namedtuple("Args", ["dataset", "output", "workers"])
+    args = Args(dataset=tiny_dataset_fio, output=fpath, workers=3)
+    inverted_index.buld_action(args)
+    loaded_index = inverted_index.InvertedIndex.load(fpath)
+
+    assert etalon == loaded_index, (
+        f"index was built incorrectly etalone={etalon.data} actual={loaded_index.data}"
+    )
+
+
+@pytest.mark.parametrize(
+    "memory_budget, storage_policy",
+    [
+        pytest.param(1, inverted_index.BinaryPolicy, id="spill every document"),
+        pytest.param(1, inverted_index.CompressedPolicy, id="spill every document compressed"),
+        pytest.param(inverted_index.DEFAULT_MEMORY_BUDGET, inverted_index.BinaryPolicy, id="single run"),
+    ],
+)
+def test_build_inverted_index_streaming(tiny_dataset_fio, tmpdir, memory_budget, storage_policy):
+    docs = inverted_index.load_documents(tiny_dataset_fio)
+    etalon = inverted_index.build_inverted_index(docs)
+
+    fpath = tmpdir.join("tiny_output")
+    inverted_index.build_inverted_index_streaming(
+        tiny_dataset_fio, fpath, memory_budget=memory_budget, storage_policy=storage_policy
+    )
+    loaded_index = inverted_index.InvertedIndex.load(fpath)
+
+    assert etalon == loaded_index, (
+        f"index was built incorrectly etalone={etalon.data} actual={loaded_index.data}"
+    )
+
+
 @pytest.fixture()
 def tiny_inverted_index_fio(tmpdir, tiny_document_sample):
     fout = tmpdir.join("tiny_index")
@@ -312,7 +437,7 @@ def tiny_inverted_index_fio(tmpdir, tiny_document_sample):
 @pytest.mark.parametrize(
     "queries, output",
     [
-        pytest.param(["A_word"], "123 37\n"),
+        pytest.param(["A_word"], "37 123\n"),
         pytest.param(["B_word"], "2 37\n"),
         pytest.param(["A_word", "B_word"], "37\n")
     ],
@@ -337,7 +462,7 @@ def test_valid_cli_queries(capsys, tmpdir, tiny_inverted_index_fio, queries, out
 @pytest.mark.parametrize(
     "encoding, queries, output",
     [
-        pytest.param("cp1251", ["A_word"], "123 37\n"),
+        pytest.param("cp1251", ["A_word"], "37 123\n"),
         pytest.param("utf8", ["B_word"], "2 37\n"),
         pytest.param("cp1251", ["A_word", "B_word"], "37\n")
     ],
@@ -371,9 +496,9 @@ def test_valid_file_queries(capsys, tmpdir, tiny_inverted_index_fio, encoding, q
 @pytest.mark.parametrize(
     "encoding, queries, output",
     [
-        pytest.param("cp1251", ["A_word"], "123 37\n"),
+        pytest.param("cp1251", ["A_word"], "37 123\n"),
         pytest.param("utf8", ["B_word"], "2 37\n"),
-        pytest.param("cp1251", ["A_word B_word", "A_word"], "37\n123 37\n")
+        pytest.param("cp1251", ["A_word B_word", "A_word"], "37\n37 123\n")
     ],
 )
 def test_valid_file_queries(capsys, tmpdir, tiny_inverted_index_fio, encoding, queries, output):
@@ -404,3 +529,546 @@ def test_valid_file_queries(capsys, tmpdir, tiny_inverted_index_fio, encoding, q
     assert output == out, (
         "incorrect stdout output"
     )
+
+
+def test_process_queries_batch_matches_process_queries(capsys, tiny_inverted_index):
+    queries = [
+        "A_word B_word\n",
+        "B_word A_word and",
+        "A_word",
+        "A_word B_word",
+        "word_does_not_exist A_word",
+        "",
+        "some",
+    ]
+    inverted_index.process_queries(tiny_inverted_index, queries)
+    etalon, _ = capsys.readouterr()
+    inverted_index.process_queries_batch(tiny_inverted_index, queries)
+    actual, _ = capsys.readouterr()
+    assert etalon == actual
+
+
+def test_server_answers_queries(tiny_inverted_index):
+    async def run_session():
+        server = await inverted_index.start_server(tiny_inverted_index, port=0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection(inverted_index.DEFAULT_SERVE_HOST, port)
+            writer.write(b"A_word\nA_word B_word\nword_does_not_exist\n")
+            await writer.drain()
+            answers = [await reader.readline() for _ in range(3)]
+            writer.close()
+            await writer.wait_closed()
+        return answers
+
+    answers = asyncio.run(run_session())
+    assert [b"37 123\n", b"37\n", b"\n"] == answers
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        pytest.param("123    some words A_word  and nothing\n", ("123", "some words A_word  and nothing")),
+        pytest.param("  ,2\t-some, word B_word!!\n", ("2", "some, word B_word")),
+        pytest.param("5 famous_phrases", ("5", "famous_phrases")),
+        pytest.param(" \n", (None, None), id="empty line"),
+    ],
+)
+def test_extract_document(line, expected):
+    assert expected == inverted_index.extract_document(line)
+
+
+def test_document_tokens_match_extract_document():
+    line = "  ,37\tall words: such as A_word and B_word are here!\n"
+    doc_id, text = inverted_index.extract_document(line)
+    assert (doc_id, inverted_index.get_words(text)) == inverted_index.TOKENIZER.document_tokens(line)
+
+
+def test_segmented_index_add_delete_merge(tmpdir, tiny_document_sample):
+    index_dir = str(tmpdir.join("segmented"))
+    idx = inverted_index.SegmentedIndex.create(
+        index_dir, inverted_index.build_inverted_index(tiny_document_sample)
+    )
+    assert ["37", "123"] == idx.query(["A_word"])
+
+    idx.add_documents({"40": "a brand new A_word", "123": "replaced text"})
+    idx.delete_documents(["2"])
+    assert ["37", "40"] == idx.query(["A_word"])
+    assert ["37"] == idx.query(["B_word"])
+    assert [] == idx.query(["nothing"])
+    assert ["123"] == idx.query(["replaced"])
+
+    documents = dict(tiny_document_sample)
+    documents.update({"40": "a brand new A_word", "123": "replaced text"})
+    del documents["2"]
+    etalon = inverted_index.build_inverted_index(documents)
+    assert etalon == idx
+
+    idx.merge()
+    assert 1 == len(idx.segments)
+    assert etalon == inverted_index.InvertedIndex.load(index_dir)
+
+
+def test_segmented_index_background_merge(tmpdir, tiny_document_sample):
+    index_dir = str(tmpdir.join("segmented"))
+    idx = inverted_index.SegmentedIndex.create(index_dir, max_segments=2)
+    for doc_id, text in tiny_document_sample.items():
+        idx.add_documents({doc_id: text})
+    idx.merge_in_background().join()
+    assert 1 == len(idx.segments)
+    assert inverted_index.build_inverted_index(tiny_document_sample) == idx
+
+
+def test_segmented_index_delete_during_merge(tmpdir, monkeypatch):
+    index_dir = str(tmpdir.join("segmented"))
+    idx = inverted_index.SegmentedIndex.create(
+        index_dir, inverted_index.build_inverted_index({"5": "alpha", "6": "alpha beta"})
+    )
+    idx.add_documents({"5": "alpha gamma"})
+    old_segments = list(idx.segments)
+    dump_sorted = inverted_index.BinaryPolicy.dump_sorted.__func__
+
+    def dump_sorted_with_delete(cls, items, filepath):
+        items = list(items)
+        idx.delete_documents(["5"])
+        return dump_sorted(cls, items, filepath)
+
+    monkeypatch.setattr(inverted_index.BinaryPolicy, "dump_sorted", classmethod(dump_sorted_with_delete))
+    idx.merge()
+    assert ["6"] == idx.query(["alpha"])
+    assert [] == idx.query(["gamma"])
+    assert ["6"] == inverted_index.InvertedIndex.load(index_dir).query(["alpha"])
+    released = [weakref.ref(segment.postings) for segment in old_segments]
+    del old_segments
+    gc.collect()
+    assert all(ref() is None for ref in released)
+
+
+def test_segmented_index_queries_during_merges(tmpdir):
+    idx = inverted_index.SegmentedIndex.create(
+        str(tmpdir.join("segmented")), inverted_index.build_inverted_index({"1": "w1 w2"})
+    )
+    errors = []
+    done = threading.Event()
+
+    def run_queries():
+        while not done.is_set():
+            try:
+                assert "1" in idx.query(["w1", "w2"])
+            except Exception as error:
+                errors.append(error)
+
+    readers = [threading.Thread(target=run_queries) for _ in range(2)]
+    for reader in readers:
+        reader.start()
+    try:
+        for doc_id in range(2, 42):
+            idx.add_documents({str(doc_id): "w1 w2 w3"})
+            idx.merge()
+    finally:
+        done.set()
+        for reader in readers:
+            reader.join()
+    assert [] == errors
+    assert [str(doc_id) for doc_id in range(1, 42)] == idx.query(["w1", "w2"])
+
+
+def brute_force_bm25(documents, words, top_k, k1=inverted_index.BM25_K1, b=inverted_index.BM25_B):
+    tokens = {int(doc_id): inverted_index.get_words(text) for doc_id, text in documents.items()}
+    avg_length = sum(len(words) for words in tokens.values()) / len(tokens)
+    scores = dict()
+    for word in set(words):
+        df = sum(1 for doc_tokens in tokens.values() if word in doc_tokens)
+        if df == 0:
+            continue
+        idf = math.log(1 + (len(tokens) - df + 0.5) / (df + 0.5))
+        for doc_id, doc_tokens in tokens.items():
+            tf = doc_tokens.count(word)
+            if tf > 0:
+                norm = k1 * (1 - b + b * len(doc_tokens) / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+    return [(score, doc_id) for doc_id, score in ranked]
+
+
+@pytest.mark.parametrize("top_k", [1, 3, 10, 100])
+@pytest.mark.parametrize(
+    "words",
+    [
+        pytest.param(["word3"], id="single word"),
+        pytest.param(["word0", "word7", "word40"], id="frequent and rare"),
+        pytest.param(["word1", "word_does_not_exist"], id="missing word"),
+    ],
+)
+def test_top_k_bm25_matches_brute_force(words, top_k):
+    rnd = random.Random(42)
+    documents = {
+        str(doc_id): " ".join(f"word{int(rnd.paretovariate(1.0)) % 50}" for _ in range(rnd.randint(3, 40)))
+        for doc_id in range(300)
+    }
+    idx = inverted_index.build_inverted_index(documents, with_frequencies=True)
+    actual = idx.top_k_bm25(words, top_k)
+    expected = brute_force_bm25(documents, words, top_k)
+    assert [doc_id for _, doc_id in expected] == [doc_id for _, doc_id in actual]
+    assert [score for score, _ in expected] == pytest.approx([score for score, _ in actual])
+
+
+def test_ranked_index_dump_and_load(tmpdir, tiny_document_sample):
+    index_fio = str(tmpdir.join("ranked.index"))
+    idx = inverted_index.build_inverted_index(tiny_document_sample, with_frequencies=True)
+    idx.dump(index_fio)
+    loaded_index = inverted_index.InvertedIndex.load(index_fio)
+    assert idx.top_k_bm25(["A_word", "some"], 3) == loaded_index.top_k_bm25(["A_word", "some"], 3)
+    assert ["37", "123"] == loaded_index.query(["A_word"])
+    assert idx.doc_lengths.average == loaded_index.doc_lengths.average
+    assert idx.doc_lengths.minimum == loaded_index.doc_lengths.minimum
+
+
+def test_rebuild_without_sidecars_drops_stale_ones(tmpdir, tiny_document_sample):
+    index_fio = str(tmpdir.join("rebuilt.index"))
+    inverted_index.build_inverted_index(
+        tiny_document_sample, with_frequencies=True, with_positions=True
+    ).dump(index_fio)
+    inverted_index.build_inverted_index({"7": "delta beta"}).dump(index_fio)
+    for suffix in inverted_index.SIDECAR_SUFFIXES:
+        assert not os.path.exists(index_fio + suffix)
+    loaded_index = inverted_index.InvertedIndex.load(index_fio)
+    with pytest.raises(ValueError):
+        loaded_index.query_ranked(["delta"], 3)
+    with pytest.raises(ValueError):
+        loaded_index.query_phrase(["delta", "beta"])
+
+
+def test_sidecars_of_another_build_are_ignored(tmpdir, tiny_document_sample):
+    first_fio = str(tmpdir.join("first.index"))
+    second_fio = str(tmpdir.join("second.index"))
+    inverted_index.build_inverted_index(tiny_document_sample, with_frequencies=True).dump(first_fio)
+    inverted_index.build_inverted_index({"7": "delta beta"}, with_frequencies=True).dump(second_fio)
+    for suffix in (".tf", ".len"):
+        os.replace(first_fio + suffix, second_fio + suffix)
+    loaded_index = inverted_index.InvertedIndex.load(second_fio)
+    assert loaded_index.term_freqs is None
+    assert ["7"] == loaded_index.query(["delta"])
+
+
+def test_ranked_query_requires_frequencies(tiny_inverted_index):
+    with pytest.raises(ValueError):
+        tiny_inverted_index.query_ranked(["A_word"])
+
+
+@pytest.mark.parametrize(
+    "left, right",
+    [
+        pytest.param([1, 5, 70000, 70001], [5, 70001, 200000], id="sparse"),
+        pytest.param(list(range(0, 20000, 2)), list(range(0, 20000, 3)), id="dense"),
+        pytest.param(list(range(10000)), [3, 9999, 10000, 65536 + 7], id="dense and sparse"),
+        pytest.param([], [1, 2], id="empty"),
+    ],
+)
+def test_roaring_bitmap_operations(left, right):
+    left_bitmap = inverted_index.RoaringBitmap(left)
+    right_bitmap = inverted_index.RoaringBitmap(right)
+    assert sorted(set(left)) == list(left_bitmap)
+    assert len(set(left)) == len(left_bitmap)
+    assert sorted(set(left) & set(right)) == list(left_bitmap & right_bitmap)
+    assert sorted(set(left) | set(right)) == list(left_bitmap | right_bitmap)
+    assert sorted(set(left) - set(right)) == list(left_bitmap - right_bitmap)
+    assert all(doc_id in left_bitmap for doc_id in left)
+    assert all((doc_id in left_bitmap) == (doc_id in left) for doc_id in right)
+    for doc_id in [0, 5, 9999, 70000, 200000]:
+        assert sum(1 for value in set(left) if value < doc_id) == left_bitmap.rank(doc_id)
+
+
+def test_dense_postings_are_kept_as_bitmaps():
+    documents = {str(doc_id): "common" + (" rare" if doc_id % 1000 == 0 else "") for doc_id in range(5000)}
+    idx = inverted_index.build_inverted_index(documents)
+    assert isinstance(idx.data["common"], inverted_index.RoaringBitmap)
+    assert not isinstance(idx.data["rare"], inverted_index.RoaringBitmap)
+    assert ["0", "1000", "2000", "3000", "4000"] == idx.query(["common", "rare"])
+
+
+def test_dense_postings_are_stored_as_bitmaps(tmpdir):
+    documents = {str(doc_id): "common" + (" rare" if doc_id % 1000 == 0 else "") for doc_id in range(70000)}
+    idx = inverted_index.build_inverted_index(documents)
+    bitmap_fio, compressed_fio = str(tmpdir.join("bitmap.index")), str(tmpdir.join("compressed.index"))
+    idx.dump(bitmap_fio)
+    idx.dump(compressed_fio, storage_policy=inverted_index.CompressedPolicy)
+    assert os.path.getsize(bitmap_fio) < 70000 * 4 // 8
+    loaded = inverted_index.InvertedIndex.load(bitmap_fio)
+    assert isinstance(loaded.data["common"], inverted_index.RoaringBitmap)
+    assert idx.data["common"] == loaded.data["common"]
+    assert not isinstance(loaded.data["rare"], inverted_index.RoaringBitmap)
+    assert idx.query(["common", "rare"]) == loaded.query(["common", "rare"])
+    assert idx.query_boolean("common NOT rare") == loaded.query_boolean("common NOT rare")
+    assert loaded == inverted_index.InvertedIndex.load(compressed_fio)
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        pytest.param("A_word B_word", ["37"], id="implicit and"),
+        pytest.param("A_word AND B_word", ["37"], id="explicit and"),
+        pytest.param("A_word OR B_word", ["2", "37", "123"], id="or"),
+        pytest.param("A_word NOT B_word", ["123"], id="and not"),
+        pytest.param("NOT some", ["5", "37"], id="pure not"),
+        pytest.param("(nothing OR dataset) some", ["2", "123"], id="parentheses"),
+        pytest.param("famous_phrases OR A_word NOT nothing", ["5", "37"], id="precedence"),
+        pytest.param("word_does_not_exist OR B_word", ["2", "37"], id="missing word"),
+    ],
+)
+def test_query_boolean(tiny_inverted_index, expression, expected):
+    assert expected == tiny_inverted_index.query_boolean(expression)
+
+
+@pytest.mark.parametrize(
+    "left, right",
+    [
+        pytest.param([1, 5, 7, 100], [5, 6, 100, 200], id="overlapping"),
+        pytest.param([3], list(range(0, 1000, 3)), id="small and large"),
+        pytest.param(list(range(0, 1000, 3)), [3, 4, 999, 2000], id="large and small"),
+        pytest.param([], [1, 2], id="empty"),
+    ],
+)
+def test_gallop_union_and_difference(left, right):
+    left_array, right_array = array.array("i", left), array.array("i", right)
+    assert sorted(set(left) | set(right)) == list(inverted_index.gallop_union(left_array, right_array))
+    assert sorted(set(left) - set(right)) == list(inverted_index.gallop_difference(left_array, right_array))
+
+
+@pytest.mark.parametrize("storage_policy", [inverted_index.BinaryPolicy, inverted_index.CompressedPolicy])
+def test_query_boolean_on_loaded_index(tmpdir, storage_policy):
+    documents = {str(doc_id): "common" + (" rare" if doc_id % 1000 == 7 else "") for doc_id in range(5000)}
+    idx = inverted_index.build_inverted_index(documents)
+    idx.data["rare"] = array.array("i", list(idx.data["rare"]) + [9000])
+    filepath = str(tmpdir.join("inverted.index"))
+    idx.dump(filepath, storage_policy=storage_policy)
+    loaded = inverted_index.InvertedIndex.load(filepath)
+    for expression in ["rare OR common", "common NOT rare", "rare NOT common", "NOT rare", "rare common"]:
+        assert idx.query_boolean(expression) == loaded.query_boolean(expression), expression
+    assert "9000" == loaded.query_boolean("rare OR common")[-1]
+    assert ["9000"] == loaded.query_boolean("rare NOT common")
+
+
+@pytest.mark.parametrize("expression", ["", "A_word OR", "(A_word", "A_word )"])
+def test_query_boolean_rejects_malformed_queries(tiny_inverted_index, expression):
+    with pytest.raises(ValueError):
+        tiny_inverted_index.query_boolean(expression)
+
+
+def levenshtein(left, right):
+    row = list(range(len(right) + 1))
+    for i, left_char in enumerate(left, 1):
+        prev, row[0] = row[0], i
+        for j, right_char in enumerate(right, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (left_char != right_char))
+    return row[-1]
+
+
+@pytest.mark.parametrize("word", ["wiki", "wikipedia", "w", "", "kiwi", "вики"])
+@pytest.mark.parametrize("max_distance", [0, 1, 2])
+def test_term_dictionary_fuzzy_matches_brute_force(word, max_distance):
+    rnd = random.Random(7)
+    vocabulary = {"".join(rnd.choice("wikpdаеви") for _ in range(rnd.randint(1, 9))) for _ in range(2000)}
+    vocabulary |= {"wiki", "wikipedia", "wikis", "kiwi"}
+    dictionary = inverted_index.TermDictionary(inverted_index.SortedTermList(vocabulary))
+    expected = sorted(term for term in vocabulary if levenshtein(word, term) <= max_distance)
+    assert expected == sorted(dictionary.fuzzy(word, max_distance))
+
+
+def test_term_dictionary_lookups_on_mmap_index(tmpdir):
+    documents = {
+        "1": "wiki wikipedia",
+        "2": "wikis and wombats",
+        "3": "kiwi",
+    }
+    index_fio = str(tmpdir.join("index.bin"))
+    inverted_index.build_inverted_index(documents).dump(index_fio)
+    idx = inverted_index.InvertedIndex.load(index_fio)
+    dictionary = idx.term_dictionary()
+    assert dictionary.exact("wiki") and not dictionary.exact("wik")
+    assert ["wiki", "wikipedia", "wikis"] == list(dictionary.prefix("wiki"))
+    assert ["1", "2"] == idx.query(["wiki*"])
+    assert ["1", "2"] == idx.query(["wiki~1"])
+    assert ["2"] == idx.query(["wiki*", "wombats"])
+    assert [] == idx.query(["zebra*"])
+    assert ["3"] == idx.query_boolean("kiwi~0 NOT wiki*")
+
+
+POSITIONAL_DOCUMENTS = {
+    "1": "to be or not to be",
+    "2": "not to worry, it is to be done",
+    "3": "be quick or be dead",
+    "4": "new york is not york new",
+}
+
+
+@pytest.fixture()
+def positional_inverted_index():
+    return inverted_index.build_inverted_index(POSITIONAL_DOCUMENTS, with_positions=True)
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        pytest.param('"to be"', ["1", "2"], id="phrase"),
+        pytest.param('"or not to be"', ["1"], id="long phrase"),
+        pytest.param('"be to"', [], id="reversed phrase"),
+        pytest.param('"new york"', ["4"], id="phrase at document start"),
+        pytest.param("be NEAR/1 or", ["1", "3"], id="near"),
+        pytest.param("worry NEAR/4 done", [], id="too far"),
+        pytest.param("worry NEAR/5 done", ["2"], id="near enough"),
+        pytest.param("quick NEAR/2 be NEAR/2 dead", ["3"], id="near chain"),
+        pytest.param("not be", ["1", "2"], id="plain words"),
+    ],
+)
+def test_query_positional(positional_inverted_index, expression, expected):
+    assert expected == positional_inverted_index.query_positional(expression)
+
+
+def test_positional_index_dump_and_load(tmpdir, positional_inverted_index):
+    index_fio = str(tmpdir.join("positional.index"))
+    positional_inverted_index.dump(index_fio)
+    loaded_index = inverted_index.InvertedIndex.load(index_fio)
+    assert ["1", "2"] == loaded_index.query_phrase(["to", "be"])
+    assert ["4"] == loaded_index.query_near(["york", "new"], 1)
+    assert isinstance(loaded_index.positions["to"], inverted_index.PositionLists)
+    assert list(positional_inverted_index.positions["to"]) == list(loaded_index.positions["to"])
+
+
+def test_phrase_query_over_bitmap_postings(tmpdir):
+    documents = {str(doc_id): "the end" if doc_id % 7 == 0 else "end the" for doc_id in range(8000)}
+    idx = inverted_index.build_inverted_index(documents, with_positions=True)
+    index_fio = str(tmpdir.join("positional.index"))
+    idx.dump(index_fio)
+    loaded_index = inverted_index.InvertedIndex.load(index_fio)
+    assert isinstance(loaded_index.data["the"], inverted_index.RoaringBitmap)
+    assert [str(doc_id) for doc_id in range(0, 8000, 7)] == loaded_index.query_phrase(["the", "end"])
+
+
+def test_positional_query_requires_positions(tiny_inverted_index):
+    with pytest.raises(ValueError):
+        tiny_inverted_index.query_phrase(["A_word", "and"])
+
+
+def test_lru_cache_evicts_least_recently_used():
+    overhead = inverted_index.CACHE_ENTRY_OVERHEAD_BYTES
+    cache = inverted_index.LRUCache(max_bytes=3 * (10 + overhead))
+    for key in "abc":
+        cache.put(key, key.upper(), 10)
+    assert "A" == cache.get("a")
+    cache.put("d", "D", 10)
+    assert cache.get("b") is None
+    assert ["A", "C", "D"] == [cache.get(key) for key in "acd"]
+    cache.put("huge", "X", 10 ** 6)
+    assert cache.get("huge") is None
+    assert {"hits": 4, "misses": 2, "items": 3, "bytes": 3 * (10 + overhead)} == cache.stats()
+
+
+def test_query_cache_hits_and_invalidation(tmpdir, tiny_document_sample):
+    idx = inverted_index.SegmentedIndex.create(
+        str(tmpdir.join("segmented")), inverted_index.build_inverted_index(tiny_document_sample)
+    )
+    idx.enable_cache()
+    assert ["37"] == idx.query(["A_word", "B_word"])
+    assert ["37"] == idx.query(["B_word", "A_word"])
+    stats = idx.cache.stats()
+    assert 1 == stats["results"]["hits"]
+    assert 2 == stats["postings"]["misses"]
+
+    idx.add_documents({"40": "A_word B_word"})
+    assert ["37", "40"] == idx.query(["A_word", "B_word"])
+
+
+def test_query_cache_returns_copies_and_caches_misses(tiny_inverted_index):
+    tiny_inverted_index.enable_cache()
+    result = tiny_inverted_index.query(["A_word"])
+    result.append("X")
+    assert ["37", "123"] == tiny_inverted_index.query(["A_word"])
+    assert tiny_inverted_index.lookup("word_does_not_exist") is None
+    assert tiny_inverted_index.lookup("word_does_not_exist") is None
+    assert 1 == tiny_inverted_index.cache.postings.hits
+
+
+def test_server_reports_cache_stats(tiny_inverted_index):
+    tiny_inverted_index.enable_cache()
+
+    async def run_session():
+        server = await inverted_index.start_server(tiny_inverted_index, port=0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection(inverted_index.DEFAULT_SERVE_HOST, port)
+            writer.write(b"A_word\nA_word\n#stats\n")
+            await writer.drain()
+            answers = [await reader.readline() for _ in range(3)]
+            writer.close()
+            await writer.wait_closed()
+        return answers
+
+    answers = asyncio.run(run_session())
+    assert [b"37 123\n", b"37 123\n"] == answers[:2]
+    assert 1 == json.loads(answers[2])["results"]["hits"]
+
+
+def test_index_diff_by_block_checksums(tmpdir, tiny_document_sample):
+    old_fio = str(tmpdir.join("old.index"))
+    new_fio = str(tmpdir.join("new.index"))
+    documents = dict(tiny_document_sample)
+    inverted_index.build_inverted_index(documents).dump(old_fio)
+    documents["40"] = "brand new A_word"
+    del documents["5"]
+    new_index = inverted_index.build_inverted_index(documents)
+    new_index.compress()
+    new_index.dump(new_fio, storage_policy=inverted_index.CompressedPolicy)
+
+    old_loaded = inverted_index.InvertedIndex.load(old_fio)
+    new_loaded = inverted_index.InvertedIndex.load(new_fio)
+    diff = old_loaded.diff(new_loaded)
+    assert ["brand", "new"] == diff.added_terms
+    assert ["be", "famous_phrases", "not", "or", "to"] == diff.removed_terms
+    assert {"A_word": ([40], [])} == diff.changed
+    assert old_loaded != new_loaded
+    assert not new_loaded.diff(inverted_index.InvertedIndex.load(new_fio))
+    assert new_loaded == inverted_index.InvertedIndex.load(new_fio)
+    assert not new_loaded.diff(inverted_index.build_inverted_index(documents)), (
+        "stored and computed checksums should match across storage policies"
+    )
+
+
+@pytest.mark.parametrize("encoding", ["cp1251", "utf8"])
+def test_stdin_queries(capsys, monkeypatch, tiny_inverted_index_fio, encoding):
+    Args = namedtuple(
+        "Args", ["index", "file_cp", "file_utf", "queries"]
+    )
+    payload = "A_word B_word\nслово\nA_word\n".encode(encoding)
+    monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(payload)))
+    arguments = Args(
+        index=tiny_inverted_index_fio,
+        file_cp="-" if encoding == "cp1251" else None,
+        file_utf="-" if encoding == "utf8" else None,
+        queries=None
+    )
+    inverted_index.query_action(arguments)
+    out, err = capsys.readouterr()
+    assert "37\n\n37 123\n" == out
+    assert not sys.stdin.closed
+
+
+def test_query_stream_is_processed_in_batches(capsys, tiny_inverted_index_fio):
+    index = inverted_index.InvertedIndex.load(tiny_inverted_index_fio)
+    consumed = []
+
+    def queries():
+        for i in range(5):
+            consumed.append(i)
+            yield "A_word\n"
+
+    batches = []
+
+    def process(inv_index, batch):
+        batches.append(len(consumed))
+        inverted_index.process_queries_batch(inv_index, batch)
+
+    inverted_index.process_query_stream(process, index, queries(), batch_size=2)
+    out, err = capsys.readouterr()
+    assert "37 123\n" * 5 == out
+    assert [2, 4, 5] == batches, "queries must be pulled lazily batch by batch"
@@ -1,9 +1,12 @@
 """
 Application for stackoverflow analytics
 """
-from collections import defaultdict
+from collections import Counter, defaultdict
+from array import array
+from bisect import bisect_left
 
 import datetime
+import html
 import re
 import csv
 import heapq
@@ -11,12 +14,30 @@ import argparse
 import json
 import logging
 import logging.config
+import multiprocessing
+import os
 from lxml import etree
+import numpy as np
 import yaml
 
 logger = logging.getLogger("application_logger")
 
 LOG_CONFIG_NM = "logging.conf.yml"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_META = "meta.json"
+SNAPSHOT_VOCABULARY = "vocabulary.txt"
+SNAPSHOT_RANKS = "ranks.bin"
+SNAPSHOT_CUMULATIVE = "cumulative.bin"
+SNAPSHOT_PRESENCE = "presence.bin"
+# year columns kept past the last year when an index grows, so appends rarely copy it
+SPARE_YEARS = 4
+APPEND_BATCH_ROWS = 200000
+QUESTION_MARKER = 'PostTypeId="1"'
+POST_TYPE_RE = re.compile(r'\sPostTypeId="([^"]*)"')
+TITLE_RE = re.compile(r'\sTitle="([^"]*)"')
+CREATION_DATE_RE = re.compile(r'\sCreationDate="(\d{4})')
+SCORE_RE = re.compile(r'\sScore="(-?\d+)"')
+ID_RE = re.compile(r'\sId="(\d+)"')
 
 
 def load_stop_words(path):
@@ -76,6 +97,47 @@ def extract_doc(string: str, stop_words):
     return result
 
 
+def scan_question(line: str, stop_words):
+    """
+    extract a question from one row without building an XML tree,
+    answers and other rows are rejected before any attribute is parsed
+    :param line:
+    :param stop_words:
+    :return: dict with title, score, year and post id (None if missing) or None
+    """
+    if QUESTION_MARKER not in line:
+        return None
+    type_id = POST_TYPE_RE.search(line)
+    if type_id is None or type_id.group(1) != "1":
+        return None
+    title = TITLE_RE.search(line)
+    creation_date = CREATION_DATE_RE.search(line)
+    score = SCORE_RE.search(line)
+    if title is None or creation_date is None or score is None:
+        return None
+    post_id = ID_RE.search(line)
+    return {
+        "title": process_title(html.unescape(title.group(1)), stop_words),
+        "score": int(score.group(1)),
+        "year": int(creation_date.group(1)),
+        "id": None if post_id is None else int(post_id.group(1))
+    }
+
+
+def iter_docs(path_posts, stop_words):
+    """
+    stream questions of a Posts.xml dump
+    :param path_posts:
+    :param stop_words:
+    :return: generator of documents made by scan_question
+    """
+    with open(path_posts, encoding="utf-8") as file_pointer:
+        for line in file_pointer:
+            doc = scan_question(line, stop_words)
+            if doc is not None:
+                yield doc
+
+
 def read_docs(path_posts, path_stop_words):
     """
     read documents
@@ -92,18 +154,570 @@ def read_docs(path_posts, path_stop_words):
     return docs
 
 
+class DocStore:
+    """
+    columnar questions: post id, score and year columns, titles as token ids in CSR layout
+    over an interned vocabulary
+
+    column properties are zero-copy NumPy views of the growing arrays: while such a view
+    is alive append raises BufferError, keep np.array(view) copies across appends
+    """
+    def __init__(self):
+        self.vocabulary = []
+        self.word_ids = dict()
+        self._post_ids = array("q")
+        self._scores = array("q")
+        self._years = array("H")
+        self._title_offsets = array("q", [0])
+        self._title_tokens = array("i")
+        self._year_scores = None
+
+    @classmethod
+    def with_vocabulary(cls, vocabulary, word_ids):
+        """
+        empty store which shares (and extends) vocabulary and word_ids with the caller
+        :param vocabulary: list of words
+        :param word_ids: word -> index in vocabulary
+        :return:
+        """
+        store = cls()
+        store.vocabulary = vocabulary
+        store.word_ids = word_ids
+        return store
+
+    @classmethod
+    def from_docs(cls, docs):
+        """
+        :param docs: iterable of documents, non-questions (empty dicts) are skipped
+        :return:
+        """
+        store = cls()
+        for doc in docs:
+            if doc:
+                store.append(doc)
+        return store
+
+    def append(self, doc):
+        """
+        add one question, the store is left unchanged if a column cannot grow
+        """
+        word_ids = self.word_ids
+        tokens = []
+        new_words = []
+        for word in doc["title"]:
+            word_id = word_ids.get(word)
+            if word_id is None:
+                word_id = len(self.vocabulary) + len(new_words)
+                new_words.append(word)
+            tokens.append(word_id)
+        columns = (self._title_tokens, self._title_offsets, self._post_ids, self._scores, self._years)
+        sizes = [len(column) for column in columns]
+        try:
+            self._title_tokens.extend(tokens)
+            self._title_offsets.append(len(self._title_tokens))
+            self._post_ids.append(-1 if doc.get("id") is None else doc["id"])
+            self._scores.append(doc["score"])
+            self._years.append(doc["year"] if "year" in doc else doc["creation_date"].year)
+        except BufferError:
+            for column, size in zip(columns, sizes):
+                if len(column) > size:
+                    del column[size:]
+            raise
+        for word in new_words:
+            word_ids[word] = len(self.vocabulary)
+            self.vocabulary.append(word)
+
+    def __len__(self):
+        return len(self._scores)
+
+    @property
+    def post_ids(self):
+        return np.frombuffer(self._post_ids, dtype=np.int64)
+
+    @property
+    def scores(self):
+        return np.frombuffer(self._scores, dtype=np.int64)
+
+    @property
+    def years(self):
+        return np.frombuffer(self._years, dtype=np.uint16)
+
+    @property
+    def title_offsets(self):
+        return np.frombuffer(self._title_offsets, dtype=np.int64)
+
+    @property
+    def title_tokens(self):
+        return np.frombuffer(self._title_tokens, dtype=np.int32)
+
+    def title(self, doc_id):
+        tokens = self._title_tokens[self._title_offsets[doc_id]:self._title_offsets[doc_id + 1]]
+        return {self.vocabulary[word_id] for word_id in tokens}
+
+    def __getitem__(self, doc_id):
+        return {
+            "title": self.title(doc_id),
+            "score": self._scores[doc_id],
+            "year": self._years[doc_id]
+        }
+
+    def nbytes(self):
+        return sum(
+            column.itemsize * len(column)
+            for column in (self._post_ids, self._scores, self._years, self._title_offsets, self._title_tokens)
+        )
+
+    def previous_versions(self):
+        """
+        for every row: the previous row of the same post id, -1 if none
+        :return:
+        """
+        ids = self.post_ids
+        order = np.argsort(ids, kind="stable")
+        sorted_ids = ids[order]
+        same = (sorted_ids[1:] == sorted_ids[:-1]) & (sorted_ids[1:] >= 0)
+        result = np.full(len(ids), -1, dtype=np.int64)
+        result[order[1:][same]] = order[:-1][same]
+        return result
+
+    def aggregate(self, rows=None, signs=None):
+        """
+        score and post count sums per (year, word id) over rows, each row taken with its sign
+        :param rows: row numbers, all rows by default
+        :param signs: +1 / -1 per row
+        :return: years, word ids, scores, counts arrays
+        """
+        if rows is None:
+            rows = np.arange(len(self))
+        return aggregate_posts(self.years, self.scores, self.title_offsets, self.title_tokens, rows, signs)
+
+    def indicies(self):
+        """
+        word_idx and year_idx of generate_indicies
+        """
+        word_idx = defaultdict(set)
+        year_idx = defaultdict(set)
+        offsets = self._title_offsets
+        for doc_id, year in enumerate(self._years):
+            for word_id in self._title_tokens[offsets[doc_id]:offsets[doc_id + 1]]:
+                word = self.vocabulary[word_id]
+                word_idx[(year, word)].add(doc_id)
+                year_idx[year].add(word)
+        return word_idx, year_idx
+
+    def year_scores(self):
+        """
+        generate_score_index result computed over the columns, cached until the next append
+        """
+        if self._year_scores is not None and self._year_scores[0] == len(self):
+            return self._year_scores[1]
+        years, word_ids, scores, _ = self.aggregate()
+        year_scores = defaultdict(Counter)
+        for year, word_id, total in zip(years.tolist(), word_ids.tolist(), scores.tolist()):
+            year_scores[year][self.vocabulary[word_id]] = total
+        self._year_scores = (len(self), dict(year_scores))
+        return self._year_scores[1]
+
+
+def aggregate_posts(years, scores, title_offsets, title_tokens, rows, signs=None):
+    """
+    score and post count sums per (year, word id) over rows of DocStore columns
+    :param years:
+    :param scores:
+    :param title_offsets:
+    :param title_tokens:
+    :param rows: row numbers
+    :param signs: +1 / -1 per row, all +1 by default
+    :return: years, word ids, scores, counts arrays
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if signs is None:
+        signs = np.ones(len(rows), dtype=np.int64)
+    starts = np.asarray(title_offsets[rows])
+    lengths = np.asarray(title_offsets[rows + 1]) - starts
+    positions = np.arange(int(lengths.sum())) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    keys = (
+        (np.repeat(np.asarray(years[rows], dtype=np.int64), lengths) << 32)
+        + np.asarray(title_tokens[positions], dtype=np.int64)
+    )
+    keys, inverse = np.unique(keys, return_inverse=True)
+    totals = np.zeros(len(keys), dtype=np.int64)
+    counts = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(totals, inverse.ravel(), np.repeat(np.asarray(scores[rows], dtype=np.int64) * signs, lengths))
+    np.add.at(counts, inverse.ravel(), np.repeat(signs, lengths))
+    return keys >> 32, keys & 0xffffffff, totals, counts
+
+
+def merge_aggregates(*aggregates):
+    """
+    sum aggregate_posts results
+    :param aggregates: (years, word ids, scores, counts) tuples
+    :return: years, word ids, scores, counts arrays
+    """
+    years, word_ids, scores, counts = (np.concatenate(columns) for columns in zip(*aggregates))
+    keys, inverse = np.unique((years << 32) + word_ids, return_inverse=True)
+    totals = np.zeros(len(keys), dtype=np.int64)
+    total_counts = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(totals, inverse.ravel(), scores)
+    np.add.at(total_counts, inverse.ravel(), counts)
+    return keys >> 32, keys & 0xffffffff, totals, total_counts
+
+
+class PostFiles:
+    """
+    DocStore columns of a snapshot as raw append-only files, and sorted runs of
+    (post id, latest row) written by every append to look up updated posts
+    """
+    COLUMNS = (
+        ("_post_ids", "posts_ids.bin", np.int64),
+        ("_scores", "posts_scores.bin", np.int64),
+        ("_years", "posts_years.bin", np.uint16),
+        ("_title_offsets", "posts_title_offsets.bin", np.int64),
+        ("_title_tokens", "posts_title_tokens.bin", np.int32),
+    )
+    VOCABULARY_FILE = "posts_vocabulary.txt"
+    ID_RUN_FILE = "posts_id_run_{}.npy"
+    MAX_ID_RUNS = 16
+
+    def __init__(self, path, id_runs=0):
+        self.path = path
+        self.id_runs = id_runs
+
+    @classmethod
+    def create(cls, path):
+        """
+        empty post files, replacing existing ones
+        :param path: snapshot directory
+        :return:
+        """
+        for attribute, name, dtype in cls.COLUMNS:
+            with open(os.path.join(path, name), "wb") as file_pointer:
+                if attribute == "_title_offsets":
+                    np.zeros(1, dtype=dtype).tofile(file_pointer)
+        with open(os.path.join(path, cls.VOCABULARY_FILE), "w", encoding="utf-8"):
+            pass
+        run = 0
+        while os.path.exists(os.path.join(path, cls.ID_RUN_FILE.format(run))):
+            os.remove(os.path.join(path, cls.ID_RUN_FILE.format(run)))
+            run += 1
+        return cls(path)
+
+    def column(self, attribute):
+        """
+        :param attribute: DocStore column name
+        :return: read-only memory mapped column
+        """
+        for column, name, dtype in self.COLUMNS:
+            if column == attribute:
+                filepath = os.path.join(self.path, name)
+                if os.path.getsize(filepath) == 0:
+                    return np.zeros(0, dtype=dtype)
+                return np.memmap(filepath, dtype=dtype, mode="r")
+        raise KeyError(attribute)
+
+    def __len__(self):
+        return os.path.getsize(os.path.join(self.path, self.COLUMNS[0][1])) // 8
+
+    def load_vocabulary(self):
+        with open(os.path.join(self.path, self.VOCABULARY_FILE), encoding="utf-8") as file_pointer:
+            return file_pointer.read().split("\n")[:-1]
+
+    def append(self, store, words_from):
+        """
+        append all rows of store, its vocabulary extends the saved one from words_from
+        :param store: DocStore
+        :param words_from:
+        :return: row number of the first appended row
+        """
+        rows_from = len(self)
+        token_base = os.path.getsize(os.path.join(self.path, self.COLUMNS[-1][1])) // 4
+        for attribute, name, dtype in self.COLUMNS:
+            values = getattr(store, attribute.lstrip("_"))
+            if attribute == "_title_offsets":
+                values = values[1:] + token_base
+            with open(os.path.join(self.path, name), "ab") as file_pointer:
+                values.astype(dtype).tofile(file_pointer)
+        with open(os.path.join(self.path, self.VOCABULARY_FILE), "a", encoding="utf-8") as file_pointer:
+            file_pointer.write("".join(word + "\n" for word in store.vocabulary[words_from:]))
+        ids = store.post_ids
+        rows = np.arange(rows_from, rows_from + len(store), dtype=np.int64)
+        known = ids >= 0
+        self._write_id_run(ids[known], rows[known])
+        return rows_from
+
+    def _write_id_run(self, ids, rows):
+        if len(ids) == 0:
+            return
+        order = np.lexsort((rows, ids))
+        ids, rows = ids[order], rows[order]
+        latest = np.append(ids[1:] != ids[:-1], True)
+        np.save(os.path.join(self.path, self.ID_RUN_FILE.format(self.id_runs)), np.stack([ids[latest], rows[latest]]))
+        self.id_runs += 1
+        if self.id_runs > self.MAX_ID_RUNS:
+            self.compact_id_runs()
+
+    def compact_id_runs(self):
+        """
+        merge id runs into one
+        """
+        runs = [np.load(os.path.join(self.path, self.ID_RUN_FILE.format(run))) for run in range(self.id_runs)]
+        for run in range(self.id_runs):
+            os.remove(os.path.join(self.path, self.ID_RUN_FILE.format(run)))
+        self.id_runs = 0
+        merged = np.concatenate(runs, axis=1)
+        self._write_id_run(merged[0], merged[1])
+
+    def latest_rows(self, ids):
+        """
+        :param ids: post ids
+        :return: latest saved row of every post id, -1 if there is none
+        """
+        result = np.full(len(ids), -1, dtype=np.int64)
+        for run in range(self.id_runs):
+            run_ids, run_rows = np.load(os.path.join(self.path, self.ID_RUN_FILE.format(run)), mmap_mode="r")
+            positions = np.minimum(np.searchsorted(run_ids, ids), len(run_ids) - 1)
+            found = run_ids[positions] == ids
+            result[found] = np.maximum(result[found], run_rows[positions[found]])
+        return result
+
+    def aggregate(self, rows, signs=None):
+        """
+        aggregate_posts over saved rows
+        """
+        return aggregate_posts(
+            self.column("_years"), self.column("_scores"),
+            self.column("_title_offsets"), self.column("_title_tokens"), rows, signs
+        )
+
+
+def read_doc_store(path_posts, stop_words):
+    """
+    read questions into a DocStore
+    :param path_posts:
+    :param stop_words:
+    :return:
+    """
+    return DocStore.from_docs(iter_docs(path_posts, stop_words))
+
+
+def file_signature(path):
+    """
+    identity of a file for snapshot validation
+    :param path:
+    :return:
+    """
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_snapshot_meta(path):
+    """
+    :param path: snapshot directory
+    :return: meta or None if there is no complete snapshot of the current version
+    """
+    try:
+        with open(os.path.join(path, SNAPSHOT_META), encoding="utf-8") as file_pointer:
+            meta = json.load(file_pointer)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != SNAPSHOT_VERSION:
+        return None
+    return meta
+
+
+def write_snapshot_meta(path, first_year, columns, sources, posts=None):
+    """
+    :param path: snapshot directory
+    :param first_year:
+    :param columns: number of matrix columns
+    :param sources: name -> file_signature
+    :param posts: offset (bytes of questions file ingested) and id_runs, None if posts are not saved
+    :return:
+    """
+    with open(os.path.join(path, SNAPSHOT_META), "w", encoding="utf-8") as file_pointer:
+        json.dump({
+            "version": SNAPSHOT_VERSION,
+            "first_year": first_year,
+            "columns": columns,
+            "sources": sources,
+            "posts": posts
+        }, file_pointer)
+
+
+def remove_snapshot_meta(path):
+    """
+    invalidate snapshot before it is modified
+    :param path: snapshot directory
+    :return:
+    """
+    meta_path = os.path.join(path, SNAPSHOT_META)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+
+def snapshot_is_fresh(path, sources):
+    """
+    check that snapshot was built from the same files
+    :param path: snapshot directory
+    :param sources: name -> file path, stored paths are checked for missing names
+    :return:
+    """
+    meta = read_snapshot_meta(path)
+    if meta is None:
+        return False
+    for name, stored in meta["sources"].items():
+        source_path = sources.get(name) or stored["path"]
+        try:
+            if file_signature(source_path) != stored:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def snapshot_is_appendable(meta, path_posts, path_stop_words):
+    """
+    check that snapshot has its posts saved and was built from a prefix of path_posts
+    with the same stop words
+    :param meta:
+    :param path_posts:
+    :param path_stop_words:
+    :return:
+    """
+    if meta is None or meta.get("posts") is None:
+        return False
+    questions = meta["sources"].get("questions")
+    try:
+        return (
+            questions is not None
+            and questions["path"] == os.path.abspath(path_posts)
+            and os.path.getsize(path_posts) >= meta["posts"]["offset"]
+            and meta["sources"].get("stop_words") == file_signature(path_stop_words)
+        )
+    except OSError:
+        return False
+
+
+def iter_appended_lines(path_posts, offset: int):
+    """
+    complete lines of posts file after offset, a trailing line without newline
+    is left for the next append
+    :param path_posts:
+    :param offset:
+    :return: generator of (line, offset after the line)
+    """
+    with open(path_posts, "rb") as file_pointer:
+        file_pointer.seek(offset)
+        for line in file_pointer:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            yield line.decode("utf-8"), offset
+
+
+def ingest_post_batch(posts, store, words_from):
+    """
+    save a batch of new posts and compute the aggregate changes it makes,
+    older versions of re-ingested post ids (saved or earlier in the batch) are subtracted
+    :param posts: PostFiles
+    :param store: DocStore with the batch
+    :param words_from: size of the saved posts vocabulary
+    :return: (years, word ids, scores, counts), number of replaced posts
+    """
+    previous = store.previous_versions()
+    ids = store.post_ids
+    first = (previous < 0) & (ids >= 0)
+    saved = posts.latest_rows(ids[first])
+    saved = saved[saved >= 0]
+    earlier = previous[previous >= 0]
+    posts.append(store, words_from)
+    changes = store.aggregate(
+        np.concatenate([np.arange(len(store)), earlier]),
+        np.concatenate([np.ones(len(store), dtype=np.int64), -np.ones(len(earlier), dtype=np.int64)])
+    )
+    if len(saved) > 0:
+        changes = merge_aggregates(changes, posts.aggregate(saved, -np.ones(len(saved), dtype=np.int64)))
+    return changes, len(saved) + len(earlier)
+
+
+def update_snapshot(path, path_posts, path_stop_words, batch_rows=APPEND_BATCH_ROWS):
+    """
+    ingest rows appended to posts file since the snapshot was saved and update
+    the aggregates, a row of an already ingested post id replaces that post;
+    the snapshot (with posts saved for later appends) is built from scratch
+    if it cannot be appended to
+    :param path: snapshot directory
+    :param path_posts:
+    :param path_stop_words:
+    :param batch_rows: questions kept in memory at once
+    :return: RangeScoreIndex
+    """
+    meta = read_snapshot_meta(path)
+    os.makedirs(path, exist_ok=True)
+    appendable = snapshot_is_appendable(meta, path_posts, path_stop_words)
+    if appendable:
+        logger.info("append to snapshot")
+        index = RangeScoreIndex.load(path, mmap_mode="r+")
+        posts = PostFiles(path, meta["posts"]["id_runs"])
+        offset = meta["posts"]["offset"]
+        remove_snapshot_meta(path)
+    else:
+        logger.info("build snapshot")
+        remove_snapshot_meta(path)
+        index = RangeScoreIndex.from_year_scores({})
+        posts = PostFiles.create(path)
+        offset = 0
+    vocabulary = posts.load_vocabulary()
+    word_ids = {word: word_id for word_id, word in enumerate(vocabulary)}
+    stop_words = load_stop_words(path_stop_words)
+    lines = iter_appended_lines(path_posts, offset)
+    changes = None
+    ingested = replaced = 0
+    while True:
+        store = DocStore.with_vocabulary(vocabulary, word_ids)
+        words_from = len(vocabulary)
+        for line, line_end in lines:
+            offset = line_end
+            doc = scan_question(line, stop_words)
+            if doc is not None:
+                store.append(doc)
+                if len(store) >= batch_rows:
+                    break
+        if len(store) == 0:
+            break
+        batch_changes, batch_replaced = ingest_post_batch(posts, store, words_from)
+        changes = batch_changes if changes is None else merge_aggregates(changes, batch_changes)
+        ingested += len(store)
+        replaced += batch_replaced
+    logger.info(f"ingested {ingested} posts, {replaced} of them replace older versions")
+    updated = index
+    if changes is not None:
+        years, changed_word_ids, scores, counts = changes
+        updated = index.apply(years, [vocabulary[word_id] for word_id in changed_word_ids.tolist()], scores, counts)
+    sources = {"questions": file_signature(path_posts), "stop_words": file_signature(path_stop_words)}
+    posts_meta = {"offset": offset, "id_runs": posts.id_runs}
+    if appendable and updated is index:
+        index.flush()
+        write_snapshot_meta(path, index.first_year, index.cumulative.shape[1], sources, posts_meta)
+    else:
+        updated.save(path, sources, posts_meta)
+    return updated
+
+
 def generate_indicies(docs):
     """
     generate inverted indicies
-    :param docs:
+    :param docs: documents or DocStore
     :return:
     """
+    if isinstance(docs, DocStore):
+        return docs.indicies()
     word_idx = defaultdict(set)
     year_idx = defaultdict(set)
     for doc_id, doc in enumerate(docs):
         try:
             logger.log(level=logging.DEBUG - 5, msg=f"processing document #{doc_id} for indicies")
-            year = doc["creation_date"].year
+            year = doc["year"] if "year" in doc else doc["creation_date"].year
             words = doc["title"]
             for word in words:
                 word_idx[(year, word)].add(doc_id)
@@ -116,6 +730,84 @@ def generate_indicies(docs):
     return word_idx, year_idx
 
 
+def generate_score_index(docs):
+    """
+    total score of every word per year, queries only merge year maps
+    :param docs: iterable of documents, consumed once, or DocStore
+    :return: dict year -> Counter word -> total score
+    """
+    if isinstance(docs, DocStore):
+        return docs.year_scores()
+    year_scores = defaultdict(Counter)
+    for doc in docs:
+        year = doc["year"] if "year" in doc else doc["creation_date"].year
+        scores = year_scores[year]
+        score = doc["score"]
+        for word in doc["title"]:
+            scores[word] += score
+    return dict(year_scores)
+
+
+def split_posts(path_posts, parts: int):
+    """
+    split posts file into byte ranges of roughly the same size
+    :param path_posts:
+    :param parts:
+    :return: list of (start, end)
+    """
+    size = os.path.getsize(path_posts)
+    step = max(1, -(-size // parts))
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def iter_post_range(path_posts, start: int, end: int):
+    """
+    lines of posts file which begin inside [start, end) byte range
+    :param path_posts:
+    :param start:
+    :param end:
+    :return:
+    """
+    with open(path_posts, "rb") as file_pointer:
+        if start > 0:
+            file_pointer.seek(start - 1)
+            file_pointer.readline()
+        while file_pointer.tell() < end:
+            line = file_pointer.readline()
+            if len(line) == 0:
+                break
+            yield line.decode("utf-8")
+
+
+def score_post_range(task):
+    """
+    pool worker: per-year word scores of one byte range of posts file
+    :param task: (path_posts, start, end, stop_words)
+    :return:
+    """
+    path_posts, start, end, stop_words = task
+    docs = (scan_question(line, stop_words) for line in iter_post_range(path_posts, start, end))
+    return generate_score_index(doc for doc in docs if doc is not None)
+
+
+def generate_score_index_parallel(path_posts, stop_words, workers: int):
+    """
+    generate_score_index over byte ranges of posts file in a process pool,
+    partial year maps are summed
+    :param path_posts:
+    :param stop_words:
+    :param workers:
+    :return:
+    """
+    tasks = [(path_posts, start, end, stop_words) for start, end in split_posts(path_posts, workers)]
+    year_scores = defaultdict(Counter)
+    with multiprocessing.Pool(workers) as pool:
+        for partial in pool.imap_unordered(score_post_range, tasks):
+            for year, scores in partial.items():
+                year_scores[year].update(scores)
+    return dict(year_scores)
+
+
 def read_queries(path):
     """
     read queries
@@ -135,41 +827,17 @@ def read_queries(path):
     return queries
 
 
-def process_query(query, word_idx, year_idx, docs):
+def make_response(query, result):
     """
-    process one query
+    response of a query, warns if there are fewer than top_n words
     :param query:
-    :param word_idx:
-    :param year_idx:
-    :param docs:
+    :param result: list of [word, score]
     :return:
     """
-    word2score = defaultdict(int)
-    for year in range(query["start"], query["finish"] + 1):
-        words = year_idx[year]
-        for word in words:
-            for word_index in word_idx[(year, word)]:
-                word2score[word] += docs[word_index]["score"]
-    score_word = [(-v, k) for k, v in word2score.items()]
-    heapq.heapify(score_word)
-    result = []
-    no_loop = True
-    for k in range(query["top_n"]):
-        if len(score_word) > 0:
-            no_loop = False
-            score, word = heapq.heappop(score_word)
-            result.append([word, -score])
-        else:
-            logger.warning(
-                f"not enough data to answer, "
-                f"found {k} words out of {query['top_n']} "
-                f"for period \"{query['start']},{query['finish']}\""
-            )
-            break
-    if no_loop and query['top_n'] > 0:
+    if len(result) < query["top_n"]:
         logger.warning(
             f"not enough data to answer, "
-            f"found 0 words out of {query['top_n']} "
+            f"found {len(result)} words out of {query['top_n']} "
             f"for period \"{query['start']},{query['finish']}\""
         )
     return {
@@ -179,20 +847,349 @@ def process_query(query, word_idx, year_idx, docs):
     }
 
 
-def process_queries(queries, docs, word_idx, year_idx):
+def top_words(word2score, top_n):
+    """
+    top_n [word, score] by score, ties by word, keeping a heap of top_n items only
+    :param word2score:
+    :param top_n:
+    :return:
+    """
+    if top_n <= 0:
+        return []
+    return [
+        [word, -score]
+        for score, word in heapq.nsmallest(top_n, ((-score, word) for word, score in word2score.items()))
+    ]
+
+
+def select_top(word2score, query):
+    """
+    top_n words by score (ties by word)
+    :param word2score:
+    :param query:
+    :return: response
+    """
+    return make_response(query, top_words(word2score, query["top_n"]))
+
+
+class RangeScoreIndex:
+    """
+    cumulative word scores over years: vocabulary x (years + 1) matrices,
+    a range total is the difference of two columns;
+    rows are kept in the order words were added, ranks give the sorted order of words
+    """
+    MATRICES = (
+        ("cumulative", SNAPSHOT_CUMULATIVE, np.int64),
+        ("presence", SNAPSHOT_PRESENCE, np.int32),
+    )
+
+    def __init__(self, vocabulary, first_year, cumulative, presence, ranks=None, path=None):
+        self.vocabulary = vocabulary
+        self.first_year = first_year
+        self.cumulative = cumulative
+        self.presence = presence
+        self.ranks = np.arange(len(vocabulary), dtype=np.int32) if ranks is None else ranks
+        # snapshot directory of an index updated in place, None in memory
+        self.path = path
+        self._sorted_ids = None
+
+    @classmethod
+    def from_year_scores(cls, year_scores):
+        """
+        :param year_scores: result of generate_score_index
+        :return:
+        """
+        vocabulary = sorted(set().union(*year_scores.values()))
+        word_ids = {word: word_id for word_id, word in enumerate(vocabulary)}
+        first_year = min(year_scores, default=0)
+        years = max(year_scores, default=-1) - first_year + 1
+        cumulative = np.zeros((len(vocabulary), years + 1), dtype=np.int64)
+        presence = np.zeros((len(vocabulary), years + 1), dtype=np.int32)
+        for year, scores in year_scores.items():
+            ids = np.fromiter((word_ids[word] for word in scores), dtype=np.int64, count=len(scores))
+            cumulative[ids, year - first_year + 1] = np.fromiter(scores.values(), dtype=np.int64, count=len(scores))
+            presence[ids, year - first_year + 1] = 1
+        np.cumsum(cumulative, axis=1, out=cumulative)
+        np.cumsum(presence, axis=1, out=presence)
+        return cls(vocabulary, first_year, cumulative, presence)
+
+    @property
+    def last_year(self):
+        return self.first_year + self.cumulative.shape[1] - 2
+
+    def sorted_ids(self):
+        """
+        word ids in the sorted order of their words
+        """
+        if self._sorted_ids is None:
+            self._sorted_ids = np.empty(len(self.ranks), dtype=np.int64)
+            self._sorted_ids[self.ranks] = np.arange(len(self.ranks))
+        return self._sorted_ids
+
+    def _lower_bound(self, word):
+        """
+        number of words in vocabulary which are less than word
+        """
+        order = self.sorted_ids()
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if self.vocabulary[order[middle]] < word:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def word_id(self, word):
+        """
+        :return: row of word, None if it is not in vocabulary
+        """
+        order = self.sorted_ids()
+        position = self._lower_bound(word)
+        if position < len(order) and self.vocabulary[order[position]] == word:
+            return int(order[position])
+        return None
+
+    def has_word(self, word):
+        return self.word_id(word) is not None
+
+    def save(self, path, sources, posts=None):
+        """
+        save matrices, ranks, vocabulary and meta, meta is written last
+        :param path: snapshot directory
+        :param sources: name -> file_signature of the files the index is built from
+        :param posts: offset (bytes of questions file ingested) and id_runs if posts are saved for appending
+        :return:
+        """
+        os.makedirs(path, exist_ok=True)
+        remove_snapshot_meta(path)
+        for attribute, name, dtype in self.MATRICES + (("ranks", SNAPSHOT_RANKS, np.int32),):
+            with open(os.path.join(path, name + ".tmp"), "wb") as file_pointer:
+                np.ascontiguousarray(getattr(self, attribute), dtype=dtype).tofile(file_pointer)
+            os.replace(os.path.join(path, name + ".tmp"), os.path.join(path, name))
+        with open(os.path.join(path, SNAPSHOT_VOCABULARY), "w", encoding="utf-8") as file_pointer:
+            file_pointer.write("".join(word + "\n" for word in self.vocabulary))
+        write_snapshot_meta(path, self.first_year, self.cumulative.shape[1], sources, posts)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        load snapshot, matrices are memory mapped
+        :param path: snapshot directory
+        :param mmap_mode: "r+" to update the snapshot in place
+        :return:
+        """
+        meta = read_snapshot_meta(path)
+        with open(os.path.join(path, SNAPSHOT_VOCABULARY), encoding="utf-8") as file_pointer:
+            vocabulary = file_pointer.read().split("\n")[:-1]
+        index = cls(
+            vocabulary, meta["first_year"], None, None,
+            map_snapshot_file(path, SNAPSHOT_RANKS, np.int32, (len(vocabulary),), "r"),
+            path if mmap_mode == "r+" else None
+        )
+        index.map_matrices(path, meta["columns"], mmap_mode)
+        return index
+
+    def map_matrices(self, path, columns, mmap_mode):
+        for attribute, name, dtype in self.MATRICES:
+            setattr(self, attribute, map_snapshot_file(path, name, dtype, (len(self.vocabulary), columns), mmap_mode))
+
+    def flush(self):
+        """
+        write in place changes of memory mapped matrices
+        """
+        for attribute, _, _ in self.MATRICES:
+            matrix = getattr(self, attribute)
+            if isinstance(matrix, np.memmap):
+                matrix.flush()
+
+    def grown(self, first_year, last_year):
+        """
+        in-memory copy of the index with years [first_year, last_year]
+        :param first_year:
+        :param last_year:
+        :return:
+        """
+        shift = self.first_year - first_year if self.cumulative.shape[1] > 1 else 0
+        old_columns = self.cumulative.shape[1]
+        matrices = []
+        for matrix in (self.cumulative, self.presence):
+            grown = np.zeros((len(self.vocabulary), last_year - first_year + 2), dtype=matrix.dtype)
+            grown[:, shift:shift + old_columns] = matrix
+            grown[:, shift + old_columns:] = matrix[:, -1:]
+            matrices.append(grown)
+        return RangeScoreIndex(list(self.vocabulary), first_year, *matrices, ranks=np.array(self.ranks))
+
+    def add_words(self, new_words):
+        """
+        append zero rows of words which are not in vocabulary and rerank the vocabulary,
+        an index updated in place appends them to its snapshot files
+        :param new_words: sorted words
+        :return:
+        """
+        if len(new_words) == 0:
+            return
+        positions = np.fromiter(
+            (self._lower_bound(word) for word in new_words), dtype=np.int64, count=len(new_words)
+        )
+        ranks = np.empty(len(self.vocabulary) + len(new_words), dtype=np.int32)
+        ranks[:len(self.vocabulary)] = self.ranks + np.searchsorted(positions, self.ranks, side="right")
+        ranks[len(self.vocabulary):] = positions + np.arange(len(new_words))
+        columns = self.cumulative.shape[1]
+        self.vocabulary.extend(new_words)
+        self.ranks = ranks
+        self._sorted_ids = None
+        if self.path is None:
+            for attribute, _, dtype in self.MATRICES:
+                matrix = getattr(self, attribute)
+                setattr(self, attribute, np.concatenate([matrix, np.zeros((len(new_words), columns), dtype=dtype)]))
+            return
+        self.flush()
+        for attribute, name, dtype in self.MATRICES:
+            with open(os.path.join(self.path, name), "ab") as file_pointer:
+                np.zeros((len(new_words), columns), dtype=dtype).tofile(file_pointer)
+        with open(os.path.join(self.path, SNAPSHOT_VOCABULARY), "a", encoding="utf-8") as file_pointer:
+            file_pointer.write("".join(word + "\n" for word in new_words))
+        with open(os.path.join(self.path, SNAPSHOT_RANKS + ".tmp"), "wb") as file_pointer:
+            ranks.tofile(file_pointer)
+        os.replace(os.path.join(self.path, SNAPSHOT_RANKS + ".tmp"), os.path.join(self.path, SNAPSHOT_RANKS))
+        self.map_matrices(self.path, columns, "r+")
+
+    def apply(self, years, words, scores, counts):
+        """
+        add score and post count changes of (year, word) pairs, new words get new rows;
+        a grown copy with SPARE_YEARS more years is returned if years do not fit, self otherwise
+        :param years: array of years
+        :param words: list of words
+        :param scores: array of score changes
+        :param counts: array of post count changes
+        :return:
+        """
+        changed = (scores != 0) | (counts != 0)
+        years, scores, counts = years[changed], scores[changed], counts[changed]
+        words = [word for word, keep in zip(words, changed.tolist()) if keep]
+        if len(words) == 0:
+            return self
+        index = self
+        first_year, last_year = int(years.min()), int(years.max())
+        if self.cumulative.shape[1] == 1 or first_year < self.first_year or last_year > self.last_year:
+            if self.cumulative.shape[1] > 1:
+                first_year, last_year = min(first_year, self.first_year), max(last_year, self.last_year)
+            index = self.grown(first_year, last_year + SPARE_YEARS)
+        word_ids = {word: index.word_id(word) for word in set(words)}
+        new_words = sorted(word for word, word_id in word_ids.items() if word_id is None)
+        word_ids.update(zip(new_words, range(len(index.vocabulary), len(index.vocabulary) + len(new_words))))
+        index.add_words(new_words)
+        rows = np.fromiter((word_ids[word] for word in words), dtype=np.int64, count=len(words))
+        columns = years - index.first_year + 1
+        changed_rows, inverse = np.unique(rows, return_inverse=True)
+        for matrix, values in ((index.cumulative, scores), (index.presence, counts)):
+            delta = np.zeros((len(changed_rows), matrix.shape[1]), dtype=np.int64)
+            np.add.at(delta, (inverse.ravel(), columns), values)
+            matrix[changed_rows] += np.cumsum(delta, axis=1).astype(matrix.dtype)
+        return index
+
+    def columns(self, start, finish):
+        years = self.cumulative.shape[1] - 1
+        low = min(max(start - self.first_year, 0), years)
+        high = min(max(finish - self.first_year + 1, 0), years)
+        return low, max(low, high)
+
+    def range_scores(self, start, finish):
+        """
+        :return: ids of words seen in the range and their total scores
+        """
+        low, high = self.columns(start, finish)
+        ids = np.flatnonzero(self.presence[:, high] - self.presence[:, low])
+        return ids, self.cumulative[ids, high] - self.cumulative[ids, low]
+
+    def top(self, query):
+        """
+        top_n words by score, ties by word rank
+        :param query:
+        :return: response
+        """
+        ids, scores = self.range_scores(query["start"], query["finish"])
+        top_n = query["top_n"]
+        if 0 < top_n < len(ids):
+            threshold = np.partition(scores, len(scores) - top_n)[len(scores) - top_n]
+            keep = scores >= threshold
+            ids, scores = ids[keep], scores[keep]
+        order = np.lexsort((self.ranks[ids], -scores))[:max(top_n, 0)]
+        result = [[self.vocabulary[word_id], int(score)] for word_id, score in zip(ids[order], scores[order])]
+        return make_response(query, result)
+
+
+def map_snapshot_file(path, name, dtype, shape, mmap_mode):
+    """
+    memory map a raw snapshot file, empty files are read as empty arrays
+    :param path: snapshot directory
+    :param name:
+    :param dtype:
+    :param shape:
+    :param mmap_mode:
+    :return:
+    """
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(os.path.join(path, name), dtype=dtype, mode=mmap_mode, shape=shape)
+
+
+def process_query(query, word_idx, year_idx, docs):
+    """
+    process one query
+    :param query:
+    :param word_idx: not used for DocStore
+    :param year_idx: not used for DocStore
+    :param docs: documents or DocStore
+    :return:
+    """
+    if isinstance(docs, DocStore):
+        return process_score_query(query, docs.year_scores())
+    word2score = defaultdict(int)
+    for year in range(query["start"], query["finish"] + 1):
+        words = year_idx[year]
+        for word in words:
+            for word_index in word_idx[(year, word)]:
+                word2score[word] += docs[word_index]["score"]
+    return select_top(word2score, query)
+
+
+def process_score_query(query, year_scores):
+    """
+    process one query over precomputed per-year word scores
+    :param query:
+    :param year_scores: result of generate_score_index
+    :return:
+    """
+    word2score = Counter()
+    for year in range(query["start"], query["finish"] + 1):
+        if year in year_scores:
+            word2score.update(year_scores[year])
+    return select_top(word2score, query)
+
+
+def process_queries(queries, docs, word_idx, year_idx, year_scores=None, range_index=None):
     """
     process queries
     :param queries:
     :param docs:
     :param word_idx:
     :param year_idx:
+    :param year_scores: if given, used instead of docs and indicies
+    :param range_index: RangeScoreIndex, used instead of all of the above
     :return:
     """
     responses = []
     for query in queries:
         logger.debug(
             f"got query \"{query['start']},{query['finish']},{query['top_n']}\"")
-        resp = process_query(query, word_idx, year_idx, docs)
+        if range_index is not None:
+            resp = range_index.top(query)
+        elif year_scores is not None:
+            resp = process_score_query(query, year_scores)
+        else:
+            resp = process_query(query, word_idx, year_idx, docs)
         responses.append(resp)
     return responses
 
@@ -206,30 +1203,82 @@ def setup_logging():
         logging.config.dictConfig(yaml.safe_load(file_pointer.read()))
 
 
+def build_range_index(path_posts, path_stop_words, workers=1):
+    """
+    parse posts and build RangeScoreIndex
+    :param path_posts:
+    :param path_stop_words:
+    :param workers:
+    :return:
+    """
+    logger.info("process XML dataset")
+    stop_words = load_stop_words(path_stop_words)
+    if workers > 1:
+        year_scores = generate_score_index_parallel(path_posts, stop_words, workers)
+    else:
+        year_scores = generate_score_index(iter_docs(path_posts, stop_words))
+    return RangeScoreIndex.from_year_scores(year_scores)
+
+
 def main():
     """
     main function
+
+    without --snapshot: parse --questions and answer --queries
+    build: --questions --stop-words --snapshot DIR, saves the index
+    query: --snapshot DIR --queries, reloads the index if it was built
+        from the same (size, mtime) questions and stop words, rebuilds otherwise
+    append: --append with --snapshot, a stale snapshot ingests only the rows
+        added to --questions since it was saved instead of being rebuilt;
+        such snapshots also keep the posts, so they are built by one process
     :return:
     """
     logger.debug("Application started")
     setup_logging()
     parser = argparse.ArgumentParser(description='Work with inverted_index.py')
     parser.add_argument('--questions', action="store",
-                        dest="questions", type=str, required=True)
+                        dest="questions", type=str)
     parser.add_argument('--stop-words', action="store",
-                        dest="stop_words", type=str, required=True)
+                        dest="stop_words", type=str)
     parser.add_argument('--queries', action="store",
-                        dest="queries", type=str, required=True)
+                        dest="queries", type=str)
+    parser.add_argument('--workers', action="store",
+                        dest="workers", type=int, default=1)
+    parser.add_argument('--snapshot', action="store",
+                        dest="snapshot", type=str)
+    parser.add_argument('--append', action="store_true",
+                        dest="append", default=False)
 
     args = parser.parse_args()
-    logger.info("process XML dataset")
-    docs = read_docs(args.questions, args.stop_words)
+    if args.append and args.snapshot is None:
+        parser.error("--append requires --snapshot")
+    if args.append and args.workers > 1:
+        parser.error("--workers cannot be used with --append, posts for appending are saved by one process")
+    sources = {"questions": args.questions, "stop_words": args.stop_words}
+    if args.snapshot is not None and snapshot_is_fresh(args.snapshot, sources):
+        logger.info("load snapshot")
+        range_index = RangeScoreIndex.load(args.snapshot)
+    else:
+        if args.questions is None or args.stop_words is None:
+            parser.error("--questions and --stop-words are required without an up to date --snapshot")
+        if args.append:
+            range_index = update_snapshot(args.snapshot, args.questions, args.stop_words)
+        else:
+            range_index = build_range_index(args.questions, args.stop_words, args.workers)
+            if args.snapshot is not None:
+                logger.info("save snapshot")
+                range_index.save(args.snapshot, {
+                    "questions": file_signature(args.questions),
+                    "stop_words": file_signature(args.stop_words)
+                })
+    if args.queries is None:
+        logger.debug("Application finished.")
+        return
     logger.info("process XML dataset, ready to serve queries")
     logger.info("ready to serve queries")
     queries = read_queries(args.queries)
     logger.info("finish processing queries")
-    word_idx, year_idx = generate_indicies(docs)
-    responses = process_queries(queries, docs, word_idx, year_idx)
+    responses = process_queries(queries, None, None, None, range_index=range_index)
     for resp in responses:
         string = json.dumps(resp)
         print(string)
@@ -1,6 +1,8 @@
 from collections import defaultdict
 from textwrap import dedent
 import datetime
+import os
+import random
 import task_cherkasov_roman_stackoverflow_analytics as task
 
 import pytest
@@ -285,3 +287,321 @@ def test_process_queries_mini():
     assert RESP_MINI == actual, (
         f"{RESP_MINI}=={actual}"
     )
+
+
+def test_scan_question_matches_extract_doc(stop_words):
+    for line in DATA_MINI_STR.split("\n"):
+        expected = task.extract_doc(string=line, stop_words=stop_words)
+        actual = task.scan_question(line, stop_words)
+        assert {
+            "title": expected["title"],
+            "score": expected["score"],
+            "year": expected["creation_date"].year,
+            "id": None
+        } == actual
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        (
+            '  <row Id="4" PostTypeId="1" CreationDate="2008-07-31T21:42:52.667" Score="-3" '
+            'Body="&lt;p&gt;PostTypeId=&quot;2&quot;" Title="C# &amp; .NET: &quot;Decimal&quot;&#xA;conversion" />',
+            {"title": {"c", "net", "decimal", "conversion"}, "score": -3, "year": 2008, "id": 4}
+        ),
+        ('  <row Id="7" PostTypeId="2" ParentId="4" CreationDate="2008-07-31T22:17:57.883" Score="5" />', None),
+        ('<posts>', None),
+    ]
+)
+def test_scan_question(stop_words, line, expected):
+    assert expected == task.scan_question(line, stop_words)
+
+
+def test_iter_docs_skips_answers(tmpdir, stop_words):
+    fio = tmpdir.join("posts.xml")
+    fio.write(
+        '<?xml version="1.0" encoding="utf-8"?>\n<posts>\n'
+        + DATA_MINI_STR.split("\n")[0] + "\n"
+        + '  <row Id="7" PostTypeId="2" ParentId="4" CreationDate="2008-07-31T22:17:57.883" Score="5" />\n'
+        + "\n".join(DATA_MINI_STR.split("\n")[1:]) + "\n</posts>\n"
+    )
+    docs = list(task.iter_docs(fio, stop_words))
+    assert [doc["score"] for doc in docs] == [10, 5, 20]
+    word_idx, year_idx = task.generate_indicies(docs)
+    assert WORD_IDX_MINI == word_idx
+    assert YEAR_IDX_MINI == year_idx
+
+
+YEAR_SCORES_MINI = {
+    2019: {"seo": 15, "better": 10, "repetition": 10},
+    2020: {"python": 20, "better": 20, "javascript": 20},
+}
+
+
+def test_generate_score_index_data_mini():
+    assert YEAR_SCORES_MINI == task.generate_score_index(iter(DATA_MINI_DOCS))
+
+
+@pytest.mark.parametrize("query, expected", list(zip(QUERIES_MINI, RESP_MINI)))
+def test_process_score_query_mini(query, expected):
+    assert expected == task.process_score_query(query, YEAR_SCORES_MINI)
+
+
+def test_process_score_query_warn(caplog):
+    query = {"start": 2000, "finish": 2001, "top_n": 3}
+    expected = {"start": 2000, "end": 2001, "top": []}
+    assert expected == task.process_score_query(query, YEAR_SCORES_MINI)
+    assert any("not enough data to answer" in message for message in caplog.messages)
+
+
+def test_process_queries_with_year_scores():
+    actual = task.process_queries(QUERIES_MINI, None, None, None, year_scores=YEAR_SCORES_MINI)
+    assert RESP_MINI == actual
+
+
+@pytest.mark.parametrize("query, expected", list(zip(QUERIES_MINI, RESP_MINI)))
+def test_range_score_index_mini(query, expected):
+    range_index = task.RangeScoreIndex.from_year_scores(YEAR_SCORES_MINI)
+    assert expected == range_index.top(query)
+
+
+def test_range_score_index_matches_year_scores(caplog):
+    rnd = random.Random(0)
+    words = [f"w{i}" for i in range(30)]
+    year_scores = {
+        year: {word: rnd.randint(-3, 5) for word in rnd.sample(words, 10)}
+        for year in range(2008, 2021) if year != 2012
+    }
+    range_index = task.RangeScoreIndex.from_year_scores(year_scores)
+    for _ in range(200):
+        start = rnd.randint(2005, 2022)
+        query = {"start": start, "finish": start + rnd.randint(-1, 8), "top_n": rnd.randint(0, 35)}
+        assert task.process_score_query(query, year_scores) == range_index.top(query), query
+
+
+def test_range_score_index_empty():
+    range_index = task.RangeScoreIndex.from_year_scores({})
+    assert {"start": 2019, "end": 2020, "top": []} == range_index.top({"start": 2019, "finish": 2020, "top_n": 0})
+
+
+def test_doc_store_data_mini():
+    store = task.DocStore.from_docs([dict()] + DATA_MINI_DOCS)
+    assert 3 == len(store)
+    assert [10, 5, 20] == store.scores.tolist()
+    assert [2019, 2019, 2020] == store.years.tolist()
+    assert {"python", "better", "javascript"} == store.title(2)
+    assert {"title": {"seo"}, "score": 5, "year": 2019} == store[1]
+    assert store.nbytes() < 200
+    word_idx, year_idx = task.generate_indicies(store)
+    assert WORD_IDX_MINI == word_idx
+    assert YEAR_IDX_MINI == year_idx
+    assert YEAR_SCORES_MINI == task.generate_score_index(store)
+    for query, expected in zip(QUERIES_MINI, RESP_MINI):
+        assert expected == task.process_query(query, word_idx, year_idx, store)
+
+
+def test_doc_store_queries_without_indicies():
+    store = task.DocStore.from_docs(DATA_MINI_DOCS[:2])
+    assert RESP_MINI[0] == task.process_query(QUERIES_MINI[0], None, None, store)
+    store.append(DATA_MINI_DOCS[2])
+    assert RESP_MINI[1] == task.process_query(QUERIES_MINI[1], None, None, store)
+
+
+def test_doc_store_cannot_grow_while_column_view_is_alive():
+    store = task.DocStore.from_docs(DATA_MINI_DOCS[:2])
+    scores = store.scores
+    with pytest.raises(BufferError):
+        store.append(DATA_MINI_DOCS[2])
+    assert 2 == len(store.post_ids) == len(store.title_offsets) - 1
+    assert {"seo", "better", "repetition"} == set(store.vocabulary)
+    copied = task.np.array(scores)
+    del scores
+    store.append(DATA_MINI_DOCS[2])
+    assert [10, 5] == copied.tolist()
+    assert [10, 5, 20] == store.scores.tolist()
+
+
+def test_doc_store_empty():
+    store = task.DocStore()
+    assert {} == task.generate_score_index(store)
+    assert {} == store.indicies()[0]
+
+
+def test_read_doc_store(data_mini, stop_words):
+    store = task.read_doc_store(data_mini, stop_words)
+    assert YEAR_SCORES_MINI == task.generate_score_index(store)
+
+
+@pytest.mark.parametrize("workers", [1, 2, 5])
+def test_generate_score_index_parallel(tmpdir, stop_words, workers):
+    fio = tmpdir.join("posts.xml")
+    fio.write("<posts>\n" + DATA_MINI_STR + "\n</posts>\n")
+    assert YEAR_SCORES_MINI == task.generate_score_index_parallel(fio, stop_words, workers)
+
+
+def test_post_ranges_cover_every_line_once(tmpdir):
+    fio = tmpdir.join("posts.xml")
+    lines = [f"<row Id=\"{i}\" />\n" * (i % 3 + 1) for i in range(50)]
+    fio.write("".join(lines))
+    for parts in [1, 3, 7, 1000]:
+        actual = [
+            line
+            for start, end in task.split_posts(fio, parts)
+            for line in task.iter_post_range(fio, start, end)
+        ]
+        assert "".join(lines) == "".join(actual)
+
+
+def test_range_score_index_snapshot(tmpdir, data_mini):
+    path = str(tmpdir.join("snapshot"))
+    sources = {"questions": task.file_signature(data_mini)}
+    task.RangeScoreIndex.from_year_scores(YEAR_SCORES_MINI).save(path, sources)
+    assert task.snapshot_is_fresh(path, {})
+    assert task.snapshot_is_fresh(path, {"questions": str(data_mini)})
+    loaded = task.RangeScoreIndex.load(path)
+    assert isinstance(loaded.cumulative, task.np.memmap)
+    for query, expected in zip(QUERIES_MINI, RESP_MINI):
+        assert expected == loaded.top(query)
+
+    data_mini.write(DATA_MINI_STR + "\n")
+    assert not task.snapshot_is_fresh(path, {})
+    assert not task.snapshot_is_fresh(str(tmpdir.join("missing")), {})
+
+
+def test_empty_range_score_index_snapshot(tmpdir):
+    path = str(tmpdir.join("snapshot"))
+    task.RangeScoreIndex.from_year_scores({}).save(path, {})
+    loaded = task.RangeScoreIndex.load(path)
+    assert {"start": 1, "end": 2, "top": []} == loaded.top({"start": 1, "finish": 2, "top_n": 0})
+
+
+def post_row(post_id, title, year, score, post_type=1):
+    return (
+        f'  <row Id="{post_id}" PostTypeId="{post_type}" CreationDate="{year}-01-02T03:04:05.678" '
+        f'Score="{score}" Title="{title}" />\n'
+    )
+
+
+def expected_range_index(posts, stop_words):
+    """
+    index of the latest version of every post
+    """
+    latest = dict()
+    for line in posts:
+        doc = task.scan_question(line, stop_words)
+        if doc is not None:
+            latest[doc["id"]] = doc
+    return task.RangeScoreIndex.from_year_scores(task.generate_score_index(latest.values()))
+
+
+def assert_same_answers(expected, actual):
+    for start in range(2005, 2025, 3):
+        for finish in range(start - 1, 2025, 4):
+            query = {"start": start, "finish": finish, "top_n": 1000}
+            assert expected.top(query) == actual.top(query), query
+
+
+def test_update_snapshot_appends_and_replaces_posts(tmpdir, stop_words):
+    path_stop_words = PATH_STOPWORDS
+    snapshot = str(tmpdir.join("snapshot"))
+    fio = tmpdir.join("posts.xml")
+    posts = [
+        "<posts>\n",
+        post_row(1, "Is SEO better done with repetition", 2019, 10),
+        post_row(2, "What is SEO", 2019, 5),
+        post_row(3, "SEO answer", 2019, 50, post_type=2),
+        post_row(4, "Python better than Javascript", 2020, 20),
+    ]
+    fio.write("".join(posts) + post_row(5, "partial row", 2020, 1)[:20])
+    built = task.update_snapshot(snapshot, str(fio), path_stop_words)
+    assert_same_answers(expected_range_index(posts, stop_words), built)
+    assert task.snapshot_is_fresh(snapshot, {})
+
+    posts += [post_row(5, "partial row", 2020, 1), post_row(2, "What is SEO", 2019, 7), post_row(6, "python", 2019, -4)]
+    fio.write("".join(posts))
+    updated = task.update_snapshot(snapshot, str(fio), path_stop_words)
+    assert_same_answers(expected_range_index(posts, stop_words), updated)
+    assert_same_answers(expected_range_index(posts, stop_words), task.RangeScoreIndex.load(snapshot))
+
+    posts += [post_row(9, "python seo", 2020, 2), post_row(6, "python", 2019, 4)]
+    fio.write("".join(posts))
+    updated = task.update_snapshot(snapshot, str(fio), path_stop_words)
+    assert isinstance(updated.cumulative, task.np.memmap), "existing words and years are updated in place"
+    assert_same_answers(expected_range_index(posts, stop_words), task.RangeScoreIndex.load(snapshot))
+
+    # new words and years, a post whose title is edited, and a post updated twice
+    posts += [
+        post_row(7, "Rust borrow checker", 2021, 30),
+        post_row(1, "Is SEO done with keywords", 2019, 12),
+        post_row(8, "Ancient question", 2008, 3),
+        post_row(7, "Rust borrow checker", 2021, 31),
+    ]
+    fio.write("".join(posts))
+    updated = task.update_snapshot(snapshot, str(fio), path_stop_words)
+    expected = expected_range_index(posts, stop_words)
+    assert_same_answers(expected, updated)
+    assert_same_answers(expected, task.RangeScoreIndex.load(snapshot))
+    post_ids = task.PostFiles(snapshot).column("_post_ids")
+    assert [1, 2, 4, 5, 2, 6, 9, 6, 7, 1, 8, 7] == post_ids.tolist()
+
+    rebuilt = task.update_snapshot(str(tmpdir.join("rebuilt")), str(fio), path_stop_words)
+    assert_same_answers(expected, rebuilt)
+
+
+def test_update_snapshot_adds_words_and_years_in_place(tmpdir, stop_words):
+    snapshot = str(tmpdir.join("snapshot"))
+    fio = tmpdir.join("posts.xml")
+    posts = [post_row(1, "python seo", 2019, 5), post_row(2, "rust seo", 2020, 3)]
+    fio.write("".join(posts))
+    task.update_snapshot(snapshot, str(fio), PATH_STOPWORDS)
+    cumulative_path = os.path.join(snapshot, task.SNAPSHOT_CUMULATIVE)
+    size = os.path.getsize(cumulative_path)
+    columns = task.read_snapshot_meta(snapshot)["columns"]
+
+    # new words sorting before, between and after the saved ones, tied scores and a new year
+    posts += [post_row(3, "aardvark quux", 2021, 3), post_row(4, "scala", 2020, 5), post_row(1, "python seo", 2019, 6)]
+    fio.write("".join(posts))
+    updated = task.update_snapshot(snapshot, str(fio), PATH_STOPWORDS)
+    assert isinstance(updated.cumulative, task.np.memmap)
+    assert size + 3 * columns * 8 == os.path.getsize(cumulative_path)
+    assert ["python", "rust", "seo", "aardvark", "quux", "scala"] == updated.vocabulary
+    expected = expected_range_index(posts, stop_words)
+    assert_same_answers(expected, updated)
+    assert_same_answers(expected, task.RangeScoreIndex.load(snapshot))
+
+
+def test_update_snapshot_in_small_batches(tmpdir, stop_words, monkeypatch):
+    monkeypatch.setattr(task.PostFiles, "MAX_ID_RUNS", 2)
+    snapshot = str(tmpdir.join("snapshot"))
+    fio = tmpdir.join("posts.xml")
+    rnd = random.Random(0)
+    words = ["python", "rust", "seo", "java", "scala", "haskell"]
+    posts = []
+    for step in range(4):
+        posts += [
+            post_row(rnd.randint(1, 15), " ".join(rnd.sample(words, 2)), rnd.randint(2008, 2012), rnd.randint(-5, 20))
+            for _ in range(10)
+        ]
+        fio.write("".join(posts))
+        updated = task.update_snapshot(snapshot, str(fio), PATH_STOPWORDS, batch_rows=3)
+        assert_same_answers(expected_range_index(posts, stop_words), updated)
+        assert task.read_snapshot_meta(snapshot)["posts"]["id_runs"] <= 2
+
+
+def test_doc_store_previous_versions():
+    store = task.DocStore.from_docs(
+        {"title": {"w"}, "score": 1, "year": 2000, "id": post_id}
+        for post_id in [5, 6, None, 5, 7, 6, None, 5]
+    )
+    assert [-1, -1, -1, 0, -1, 1, -1, 3] == store.previous_versions().tolist()
+
+
+@pytest.mark.parametrize("top_n", [-1, 0, 1, 3, 10, 50])
+def test_top_words(top_n):
+    rnd = random.Random(top_n)
+    word2score = {f"w{i:02d}": rnd.randint(-2, 3) for i in range(30)}
+    expected = [
+        [word, score]
+        for word, score in sorted(word2score.items(), key=lambda item: (-item[1], item[0]))
+    ][:max(top_n, 0)]
+    assert expected == task.top_words(word2score, top_n)